@@ -7,43 +7,255 @@
 # provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
 # and the source website is properly cited
 
+import numpy as np
+
+def _window_codes(turns, model_order, n_windows, n_levels=2):
+    """Encode each window of model_order turns as an integer
+    
+    Windows are read as base-n_levels numbers, first turn as the most 
+    significant digit, so codes index states_order directly. Built with one 
+    multiply-add pass per turn of the window (a shift-or for binary turns).
+    
+    Inputs:
+        turns - integer array of turn lengths, binned into 0..n_levels-1
+        model_order - the number of turns in each window
+        n_windows - the number of windows to encode, starting from turn 0
+        n_levels - the number of turn length bins
+    """
+    
+    codes = np.zeros(n_windows, dtype=np.int64)
+    for j in range(model_order):
+        if n_levels == 2:
+            codes = (codes << 1) | turns[j:j+n_windows]
+        else:
+            codes = codes*n_levels + turns[j:j+n_windows]
+    return codes
+
+def _trans_codes(turns, state_codes, model_order, n_trans, n_levels=2):
+    """Encode each transition as an integer indexing trans_order
+    
+    A transition from state code s into a turn of length bin x has code
+    x*n_levels^model_order + s, matching the layout of trans_order.
+    """
+    
+    return turns[model_order:model_order+n_trans]*n_levels**model_order + state_codes[:n_trans]
+
+def _decode(codes, n_digits, n_levels=2):
+    """Decode integer codes into rows of base-n_levels digits, most significant first"""
+    
+    powers = n_levels**np.arange(n_digits-1, -1, -1, dtype=np.int64)
+    return (np.asarray(codes, dtype=np.int64)[:,None] // powers) % n_levels
+
+def _marginal_codes(codes, n_digits, n_levels_joint, n_levels, speakers=None, last=0):
+    """Map joint speaker x length codes to length codes
+    
+    Returns a logical array of the codes kept (those whose digit at position 
+    last is by one of speakers, if given) and the length codes they map to.
+    """
+    
+    digits = _decode(codes, n_digits, n_levels_joint)
+    if speakers is None:
+        keep = np.ones(len(digits), dtype=bool)
+    else:
+        keep = np.isin(digits[:, last] // n_levels, speakers)
+    powers = n_levels**np.arange(n_digits-1, -1, -1, dtype=np.int64)
+    return keep, (digits[keep] % n_levels) @ powers
+
+def _check_levels(turns, n_levels):
+    """Raise an error if any turn is outside the bins 0..n_levels-1"""
+    
+    if len(turns) and (turns.min() < 0 or turns.max() >= n_levels):
+        raise ValueError('Turn lengths must be binned into 0..' + str(n_levels-1))
+
+def _check_order(model_order, n_levels):
+    """Raise an error if the number of transition codes, n_levels^(model_order+1), overflows int64"""
+    
+    if n_levels**(model_order+1) > np.iinfo(np.int64).max:
+        raise ValueError('n_levels^(model_order+1) = ' + str(n_levels) + '^' + str(model_order+1) 
+                         + ' does not fit in a 64-bit integer; use a lower model_order')
+
+def _from_counts(turn_lengths, model_order, states_counts, trans_counts, 
+                 state_codes=None, trans_codes=None, n_levels=2):
+    """Build a CODYM from counts (aligned to codes, for a sparse CODYM)"""
+    
+    c_new = CODYM([], model_order, sparse=state_codes is not None, n_levels=n_levels)
+    c_new.turn_lengths = turn_lengths
+    if state_codes is not None:
+        c_new.state_codes = state_codes
+        c_new.trans_codes = trans_codes
+    c_new.states_counts = states_counts
+    c_new.trans_counts = trans_counts
+    c_new.states_obs = _normalize(states_counts)
+    c_new.trans_obs = _normalize(trans_counts)
+    return(c_new)
+
+def _normalize(counts):
+    """Convert a vector of counts to a list of frequencies (all 0 if empty)"""
+    
+    total = counts.sum()
+    if total == 0:
+        return [0]*len(counts)
+    return (counts / total).tolist()
+
 class CODYM():
 
-    def __init__(self, turn_lengths, model_order, *mask):
+    def __init__(self, turn_lengths, model_order, *mask, sparse=False, n_levels=2):
         """Populate a CODYM based on an observed sequence of binarized turn lengths
         
         Inputs:
             turn_lengths - the list of binarized turn lengths
             model_order - the order of the CODYM model
             mask - a logical mask of turns to be included in the CODYM
+            sparse - only store the states and transitions that are observed,
+                     so memory no longer grows as 2^model_order
+            n_levels - the number of turn length bins (e.g. 3 for short/medium/long),
+                       with turn lengths binned into 0..n_levels-1
         Example call:
             CODYM(list(np.random.randint(0,2,100)), 2)
+            CODYM(list(np.random.randint(0,2,100)), 20, sparse=True)
+            CODYM(list(np.random.randint(0,3,100)), 2, n_levels=3)
         """
 
         self.model_order = model_order
-        self.turn_lengths = turn_lengths        
-        self.states_order = [[int(i) for i in "{0:b}".format(j).zfill(model_order)] for j in range(2**model_order)]
-        self.trans_order = [t + t[1:] + [0] for t in self.states_order] + [t + t[1:] + [1] for t in self.states_order]
+        self.turn_lengths = turn_lengths
+        self.sparse = sparse
+        self.n_levels = n_levels
+        _check_order(model_order, n_levels)
+        
+        turns = np.asarray(turn_lengths, dtype=np.int64)
+        _check_levels(turns, n_levels)
+        
+        # NOTE: The final window of the sequence is not counted as a state, so
+        # there are len(turn_lengths)-model_order states and one fewer transition
+        n_states = max(len(turns) - model_order, 0)
+        n_trans = max(n_states - 1, 0)
         
-        # FIX - trying to make this match my results
-        # states = [turn_lengths[i:i+model_order] for i in range(len(turn_lengths)-model_order+1)]
-        states = [turn_lengths[i:i+model_order] for i in range(len(turn_lengths)-model_order)]    
-        transitions = [states[i] + states[i+1] for i in range(len(states)-1)]
+        states = _window_codes(turns, model_order, n_states, n_levels)
+        transitions = _trans_codes(turns, states, model_order, n_trans, n_levels)
     
         if len(mask):
-            if not any(mask):
+            if not len(mask[0]):
                 print('Mask contains no selected turns, being ignored')
             else:
-                states = [states[i] for i in range(len(states)) if mask[0][model_order-1:][i]]
-                # FIX STARTING HERE
-                transitions = [transitions[i] for i in range(len(transitions)) if mask[0][model_order:][i]]
-                # transitions = [transitions[i] for i in range(len(transitions)) if mask[0][model_order-2:][i]]
+                # A state is selected by its last turn, a transition by its new turn
+                mask = np.asarray(mask[0], dtype=bool)
+                states = states[mask[model_order-1:model_order-1+n_states]]
+                transitions = transitions[mask[model_order:model_order+n_trans]]
     
-        states_counts = [states.count(self.states_order[i]) for i in range(len(self.states_order))]
-        trans_counts = [transitions.count(self.trans_order[i]) for i in range(len(self.trans_order))]
+        if sparse:
+            # Integer codes of the observed states/transitions, sorted, with 
+            # states_obs and trans_obs aligned to them
+            self.state_codes, states_counts = np.unique(states, return_counts=True)
+            self.trans_codes, trans_counts = np.unique(transitions, return_counts=True)
+        else:
+            self.state_codes = np.arange(n_levels**model_order)
+            self.trans_codes = np.arange(n_levels**(model_order+1))
+            states_counts = np.bincount(states, minlength=n_levels**model_order)
+            trans_counts = np.bincount(transitions, minlength=n_levels**(model_order+1))
             
-        self.states_obs = [i/sum(states_counts) if sum(states_counts) != 0 else 0 for i in states_counts]
-        self.trans_obs = [i/sum(trans_counts) if sum(trans_counts) != 0 else 0 for i in trans_counts]
+        # Raw counts are kept so CODYMs can be merged exactly (see codym_merge).
+        # n_convs is the number of conversations the CODYM summarizes
+        self.states_counts = states_counts
+        self.trans_counts = trans_counts
+        self.n_convs = 1
+        
+        self.states_obs = _normalize(states_counts)
+        self.trans_obs = _normalize(trans_counts)
+        
+    @property
+    def states_order(self):
+        """Turn length bins of each state in states_obs (decoded on demand)"""
+        return _decode(self.state_codes, self.model_order, self.n_levels).tolist()
+    
+    @property
+    def trans_order(self):
+        """Turn length bins of each transition in trans_obs (decoded on demand)
+        
+        Each transition is written as the previous state followed by the next 
+        state, e.g. [0,1,1,0] for the 2nd-order transition SL -> LS.
+        """
+        bits = _decode(self.trans_codes, self.model_order+1, self.n_levels)
+        return np.hstack((bits[:,1:], bits[:,2:], bits[:,:1])).tolist()
+    
+    def _dense_trans(self):
+        """Transition frequencies over all codes
+        
+        trans_obs is used rather than counts: the counts of an average CODYM 
+        (codym_avg, codym_avg_counts) are pooled over turns, so their ratios 
+        differ from the per-conversation average the CODYM represents.
+        """
+        
+        trans = np.asarray(self.trans_obs, dtype=float)
+        if np.any(trans < 0):
+            raise ValueError('Transition probabilities are undefined for difference CODYMs')
+        if self.sparse:
+            trans = np.bincount(self.trans_codes, trans, minlength=self.n_levels**(self.model_order+1))
+        return trans
+    
+    def transition_matrix(self):
+        """Conditional probability of moving from each state (row) to each state (column)"""
+        return codym_transition_matrix(self._dense_trans(), self.model_order, self.n_levels)
+    
+    def stationary_distribution(self):
+        """Long-run frequency of each state of the Markov chain of the transitions"""
+        return codym_stationary(self._dense_trans(), self.model_order, self.n_levels)
+    
+    def entropy_rate(self):
+        """Entropy (bits per turn) of the next turn length, given the current state"""
+        return codym_entropy_rate(self._dense_trans(), self.model_order, self.n_levels)
+    
+    def marginalize(self, n_levels=2, speakers=None):
+        """Reduce a joint speaker x length CODYM (see codym_joint) to a length CODYM
+        
+        Each joint symbol speaker*n_levels + length is mapped back to its 
+        length, and the counts of states/transitions that become the same are
+        summed, without rescanning the turns. If speakers are given, only 
+        states whose last turn and transitions whose new turn is by one of 
+        them are kept, which matches masking the length CODYM by speaker.
+        
+        Inputs:
+            n_levels - the number of turn length bins in the joint alphabet
+            speakers - optional list of speaker ids to keep
+        Returns:
+            a CODYM over n_levels turn length bins (sparse if this one is)
+        Example call:
+            joint = codym_joint(turn_lengths, speaker, 3)
+            joint.marginalize()     # Same as CODYM(turn_lengths, 3, sparse=True)
+            joint.marginalize(2, [0]) # Same as CODYM(turn_lengths, 3, speaker==0, sparse=True)
+        """
+        
+        if self.n_levels % n_levels:
+            raise ValueError('n_levels must divide the number of levels of the joint CODYM')
+        if speakers is not None and (self.states_counts is None or self.n_convs > 1):
+            # Frequencies must be renormalized per conversation after dropping codes
+            raise ValueError('Select speakers of single CODYMs, or use codym_marginal_counts')
+        
+        k = self.model_order
+        c_new = CODYM([], k, sparse=self.sparse, n_levels=n_levels)
+        c_new.turn_lengths = (np.asarray(self.turn_lengths, dtype=np.int64) % n_levels).tolist()
+        c_new.n_convs = self.n_convs
+        for (codes, obs, counts, n_digits, last) in [('state_codes', 'states_obs', 'states_counts', k, k-1), 
+                                                     ('trans_codes', 'trans_obs', 'trans_counts', k+1, 0)]:
+            keep, new_codes = _marginal_codes(getattr(self, codes), n_digits, self.n_levels, 
+                                              n_levels, speakers, last)
+            if self.sparse:
+                union, new_codes = np.unique(new_codes, return_inverse=True)
+                setattr(c_new, codes, union)
+                n_codes = len(union)
+            else:
+                n_codes = n_levels**n_digits
+            if getattr(self, counts) is None:
+                setattr(c_new, counts, None)
+            else:
+                summed = np.bincount(new_codes, getattr(self, counts)[keep], minlength=n_codes)
+                setattr(c_new, counts, summed.astype(np.int64))
+            if speakers is None:
+                # Summing frequencies is exact for averages and differences too
+                setattr(c_new, obs, np.bincount(new_codes, np.asarray(getattr(self, obs))[keep], 
+                                                minlength=n_codes).tolist())
+            else:
+                setattr(c_new, obs, _normalize(getattr(c_new, counts)))
+        return(c_new)
         
  
     # def populate_CODYM(turn_lengths, model_order, *mask):
@@ -82,17 +294,741 @@ class CODYM():
     #     return CODYM(states_obs, trans_obs, states_order, trans_order)
     
     def __sub__(self, codym):
-        c_new = CODYM([],self.model_order)
-        c_new.states_obs = [i-j for (i,j) in zip(self.states_obs, codym.states_obs)]
-        c_new.trans_obs = [i-j for (i,j) in zip(self.trans_obs, codym.trans_obs)]
+        if self.sparse or codym.sparse:
+            c_new = _sparse_combine([self, codym], [1, -1])
+        else:
+            c_new = CODYM([],self.model_order, n_levels=self.n_levels)
+            c_new.states_obs = [i-j for (i,j) in zip(self.states_obs, codym.states_obs)]
+            c_new.trans_obs = [i-j for (i,j) in zip(self.trans_obs, codym.trans_obs)]
+        
+        # A difference CODYM has no meaningful counts
+        c_new.states_counts = None
+        c_new.trans_counts = None
         return(c_new)
+    
+    def __add__(self, codym):
+        return codym_merge([self, codym])
+    
+    def __radd__(self, other):
+        # Lets sum() reduce a list of CODYMs
+        if isinstance(other, int) and other == 0:
+            return self
+        return NotImplemented
+        
+class StreamingCODYM():
+
+    def __init__(self, model_order, sparse=False, n_levels=2):
+        """Incrementally populate a CODYM as the turns of a conversation arrive
+        
+        Only the last model_order+1 turns are kept, as an integer register, so 
+        each push updates the counts in constant time. At any point, 
+        states_obs/trans_obs match CODYM(turns so far, model_order, include 
+        flags so far); as in CODYM, the most recent turn only enters the 
+        counts once the turn after it arrives.
+        
+        Inputs:
+            model_order - the order of the CODYM model
+            sparse - store counts for observed states/transitions only
+            n_levels - the number of turn length bins, as for CODYM
+        Example call:
+            stream = StreamingCODYM(3)
+            for turn_length in [0,1,1,0,1]:
+                stream.push(turn_length)
+            stream.trans_obs
+        """
+        
+        _check_order(model_order, n_levels)
+        self.model_order = model_order
+        self.sparse = sparse
+        self.n_levels = n_levels
+        self.n_turns = 0
+        self._register = 0 # The last model_order+1 turns, most recent in the lowest digit
+        self._include = False # Whether the most recent turn is included
+        if sparse:
+            self._states_counts = {}
+            self._trans_counts = {}
+        else:
+            self._states_counts = np.zeros(n_levels**model_order, dtype=np.int64)
+            self._trans_counts = np.zeros(n_levels**(model_order+1), dtype=np.int64)
+    
+    def push(self, turn_length, include=True):
+        """Add the next binarized turn length (include is its mask value)"""
+        
+        k = self.model_order
+        b = self.n_levels
+        if not 0 <= int(turn_length) < b:
+            raise ValueError('Turn lengths must be binned into 0..' + str(b-1))
+        
+        # Count the state and transition ending at the previous turn, which 
+        # stopped being the final window of the sequence
+        i_prev = self.n_turns - 1
+        if self._include and i_prev >= k-1:
+            state = self._register % b**k
+            if self.sparse:
+                self._states_counts[state] = self._states_counts.get(state, 0) + 1
+            else:
+                self._states_counts[state] += 1
+        if self._include and i_prev >= k:
+            window = self._register % b**(k+1)
+            trans = (window % b)*b**k + window // b
+            if self.sparse:
+                self._trans_counts[trans] = self._trans_counts.get(trans, 0) + 1
+            else:
+                self._trans_counts[trans] += 1
+        
+        self._register = (self._register*b + int(turn_length)) % b**(k+1)
+        self._include = bool(include)
+        self.n_turns += 1
+        
+    @property
+    def states_obs(self):
+        return self.to_codym().states_obs
+    
+    @property
+    def trans_obs(self):
+        return self.to_codym().trans_obs
+        
+    def to_codym(self):
+        """Return a CODYM of the turns pushed so far"""
+        
+        c_new = CODYM([], self.model_order, sparse=self.sparse, n_levels=self.n_levels)
+        if self.sparse:
+            c_new.state_codes = np.array(sorted(self._states_counts), dtype=np.int64)
+            c_new.trans_codes = np.array(sorted(self._trans_counts), dtype=np.int64)
+            c_new.states_counts = np.array([self._states_counts[i] for i in c_new.state_codes], dtype=np.int64)
+            c_new.trans_counts = np.array([self._trans_counts[i] for i in c_new.trans_codes], dtype=np.int64)
+        else:
+            c_new.states_counts = self._states_counts.copy()
+            c_new.trans_counts = self._trans_counts.copy()
+        c_new.states_obs = _normalize(c_new.states_counts)
+        c_new.trans_obs = _normalize(c_new.trans_counts)
+        return(c_new)
+        
+def _sparse_combine(clist, weights=None):
+    """Weighted sum of CODYMs over the union of their observed codes
+    
+    Used for sparse CODYMs, whose states_obs/trans_obs are only aligned to 
+    their own state_codes/trans_codes. Counts are summed (unweighted) when all 
+    CODYMs have them. With no weights, only counts are combined. The result 
+    is a sparse CODYM.
+    """
+    
+    c_new = CODYM([], clist[0].model_order, sparse=True, n_levels=clist[0].n_levels)
+    has_counts = all(c.states_counts is not None for c in clist)
+    for codes, obs, counts in [('state_codes', 'states_obs', 'states_counts'), 
+                               ('trans_codes', 'trans_obs', 'trans_counts')]:
+        all_codes = np.concatenate([getattr(c, codes) for c in clist])
+        union, i_union = np.unique(all_codes, return_inverse=True)
+        setattr(c_new, codes, union)
+        if weights is not None:
+            all_obs = np.concatenate([np.asarray(getattr(c, obs), dtype=float)*w for (c,w) in zip(clist, weights)])
+            setattr(c_new, obs, np.bincount(i_union, weights=all_obs, minlength=len(union)).tolist())
+        if has_counts:
+            summed = np.zeros(len(union), dtype=np.int64)
+            np.add.at(summed, i_union, np.concatenate([getattr(c, counts) for c in clist]))
+            setattr(c_new, counts, summed)
+        else:
+            setattr(c_new, counts, None)
+    return(c_new)
+
+def codym_merge(clist):
+    """Pool CODYMs by summing their counts, normalizing only at the end
+    
+    Merging is associative and commutative, so partial results (e.g., from 
+    separate workers or files) can be reduced in any order. The frequencies of
+    the merged CODYM are weighted by the number of turns in each conversation.
+    Equivalent to c1 + c2 + ... 
+    
+    Inputs:
+        clist - list of CODYMs of the same model order, with counts
+    Example call:
+        codym_merge([CODYM(list(np.random.randint(0,2,100)), 2) for i in range(10)])
+    """
+    
+    if any(c.states_counts is None for c in clist):
+        raise ValueError('Only CODYMs with counts can be merged (e.g., not difference CODYMs)')
+    if len(set((c.model_order, c.n_levels) for c in clist)) > 1:
+        raise ValueError('Only CODYMs of the same model order and number of levels can be merged')
+    
+    if any(c.sparse for c in clist):
+        c_new = _sparse_combine(clist)
+    else:
+        c_new = CODYM([], clist[0].model_order, n_levels=clist[0].n_levels)
+        c_new.states_counts = np.sum([c.states_counts for c in clist], axis=0)
+        c_new.trans_counts = np.sum([c.trans_counts for c in clist], axis=0)
+    c_new.states_obs = _normalize(c_new.states_counts)
+    c_new.trans_obs = _normalize(c_new.trans_counts)
+    c_new.n_convs = sum(c.n_convs for c in clist)
+    return(c_new)
         
 def codym_avg(clist):
     # NOTE: This avg is NOT weighted by the number of turns in a conversation
-    c_new = CODYM([], clist[0].model_order)
-    c_new.states_obs = [sum(col) / len(col) for col in zip(*[c.states_obs for c in clist])]
-    c_new.trans_obs = [sum(col) / len(col) for col in zip(*[c.trans_obs for c in clist])]
+    # (use codym_merge for that). Each CODYM is weighted by its n_convs, so 
+    # averaging the averages of separate shards equals averaging all at once.
+    # The counts of the average are the pooled counts.
+    n_convs = np.array([c.n_convs for c in clist])
+    if any(c.sparse for c in clist):
+        c_new = _sparse_combine(clist, n_convs / n_convs.sum())
+    else:
+        c_new = CODYM([], clist[0].model_order, n_levels=clist[0].n_levels)
+        c_new.states_obs = (n_convs @ np.array([c.states_obs for c in clist]) / n_convs.sum()).tolist()
+        c_new.trans_obs = (n_convs @ np.array([c.trans_obs for c in clist]) / n_convs.sum()).tolist()
+        if all(c.states_counts is not None for c in clist):
+            c_new.states_counts = np.sum([c.states_counts for c in clist], axis=0)
+            c_new.trans_counts = np.sum([c.trans_counts for c in clist], axis=0)
+        else:
+            c_new.states_counts = None
+            c_new.trans_counts = None
+    c_new.n_convs = int(n_convs.sum())
     return(c_new)
     
     # c_new.state_obs = list(np.mean([c.states_obs for c in clist],axis=0))
     # c_new.state_obs = list(np.mean([c.states_obs for c in clist],axis=0))
+
+def codym_counts(turn_lengths, offsets, model_order, mask=None, n_levels=2):
+    """Count the states and transitions of every conversation in a corpus
+    
+    The corpus is given as one flat sequence of binarized turn lengths, with 
+    conversation i spanning turn_lengths[offsets[i]:offsets[i+1]]. Row i of 
+    the outputs holds the counts that CODYM(conversation i, model_order, mask i)
+    is built from, computed for all conversations in a single pass. offsets 
+    need not start at 0, so a slice of the offsets of a larger corpus counts 
+    just those conversations.
+    
+    Inputs:
+        turn_lengths - flat array of binarized turn lengths for all conversations
+        offsets - array of n_conversations+1 start offsets into turn_lengths
+        model_order - the order of the CODYM model
+        mask - optional flat logical mask of turns to be included, matching turn_lengths
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        states_counts - (n_conversations x n_levels^model_order) array of state counts
+        trans_counts - (n_conversations x n_levels^(model_order+1)) array of transition counts
+    Example call:
+        codym_counts(np.random.randint(0,2,100), [0,40,100], 2)
+    """
+    
+    turns = np.asarray(turn_lengths, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_convs = len(offsets) - 1
+    _check_levels(turns, n_levels)
+    _check_order(model_order, n_levels)
+    
+    # Windows of the turns the conversations span, from their first turn
+    first = offsets[0]
+    n_windows = max(offsets[-1] - first - model_order, 0)
+    states = _window_codes(turns[first:], model_order, n_windows, n_levels)
+    transitions = _trans_codes(turns[first:], states, model_order, max(n_windows-1, 0), n_levels)
+    
+    states_counts = np.zeros((n_convs, n_levels**model_order), dtype=np.int64)
+    trans_counts = np.zeros((n_convs, n_levels**(model_order+1)), dtype=np.int64)
+    i_conv, s, t = _count_windows(states, transitions, first, offsets, model_order, mask, n_levels)
+    states_counts[i_conv:i_conv+len(s)] = s
+    trans_counts[i_conv:i_conv+len(t)] = t
+    return(states_counts, trans_counts)
+
+def _count_windows(states, transitions, start, offsets, model_order, mask=None, n_levels=2):
+    """Count window codes per conversation
+    
+    Inputs:
+        states, transitions - codes of consecutive windows starting at turn start
+        start - turn at which the first window starts
+        offsets - start offsets of each conversation, as for codym_counts
+        model_order - the order of the CODYM model
+        mask - optional logical mask over all turns
+        n_levels - the number of turn length bins
+    Returns:
+        i_conv - the first conversation any of the windows fall in
+        states_counts, trans_counts - count rows of conversations i_conv onwards,
+                                      up to the last conversation the windows fall in
+    """
+    
+    n_codes = n_levels**model_order
+    n_trans_codes = n_levels*n_codes
+    if not len(states):
+        return 0, np.zeros((0, n_codes), dtype=np.int64), np.zeros((0, n_trans_codes), dtype=np.int64)
+    
+    # Conversation (and its end) for each window, by the window's first turn 
+    pos = start + np.arange(len(states))
+    i_conv, i_last = np.searchsorted(offsets, [pos[0], pos[-1]], side='right') - 1
+    n_convs = i_last - i_conv + 1
+    conv = np.repeat(np.arange(n_convs), np.diff(offsets[i_conv:i_last+2]))
+    conv = conv[start-offsets[i_conv]:start-offsets[i_conv]+len(states)]
+    end = offsets[i_conv+1:i_last+2][conv]
+    
+    # Same window ranges as CODYM: the final window of each conversation is 
+    # not a state, and the final state has no outgoing transition
+    is_state = pos < end - model_order
+    is_trans = (pos < end - model_order - 1)[:len(transitions)]
+    if mask is not None:
+        mask = np.asarray(mask[start+model_order-1:start+model_order+len(states)], dtype=bool)
+        is_state &= mask[:len(states)]
+        is_trans &= mask[1:1+len(transitions)]
+    
+    states_counts = np.bincount(conv[is_state]*n_codes + states[is_state], 
+                                minlength=n_convs*n_codes).reshape(n_convs, n_codes)
+    trans_counts = np.bincount(conv[:len(transitions)][is_trans]*n_trans_codes + transitions[is_trans], 
+                               minlength=n_convs*n_trans_codes).reshape(n_convs, n_trans_codes)
+    return(i_conv, states_counts, trans_counts)
+
+def codym_counts_multi_order(turn_lengths, offsets, max_order, mask=None, n_levels=2):
+    """Count the states and transitions of every order 1..max_order in one pass
+    
+    Only the (max_order+1)-turn windows are counted over the whole corpus. 
+    Every lower order is a marginal of that table: a window's last k+1 turns 
+    are the order-k transition ending on the same turn, selected by the same 
+    mask value. The few windows near the start and end of each conversation 
+    that differ between orders are corrected for explicitly, so each order 
+    matches codym_counts exactly.
+    
+    Inputs:
+        turn_lengths, offsets, mask - the corpus, as for codym_counts
+        max_order - the highest order of CODYM to count
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        dict mapping each order to its (states_counts, trans_counts), as codym_counts
+    Example call:
+        codym_counts_multi_order(np.random.randint(0,2,100), [0,40,100], 3)[2]
+    """
+    
+    turns = np.asarray(turn_lengths, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    _check_levels(turns, n_levels)
+    _check_order(max_order, n_levels)
+    
+    # Only the turns the conversations span are counted (offsets need not start at 0)
+    turns = turns[offsets[0]:offsets[-1]]
+    if mask is not None:
+        mask = mask[offsets[0]:offsets[-1]]
+    offsets = offsets - offsets[0]
+    n_convs = len(offsets) - 1
+    n_turns = offsets[-1]
+    b = n_levels
+    n_full = b**(max_order+1)
+    if n_convs == 0:
+        return({k: (np.zeros((0, b**k), dtype=np.int64), np.zeros((0, b**(k+1)), dtype=np.int64))
+                for k in range(1, max_order+1)})
+    
+    # Code of the (up to) max_order+1 turns ending at each turn, with the most
+    # recent turn in the lowest digit, so the last m turns are code % b^m
+    ends = np.zeros(n_turns, dtype=np.int64)
+    for j in range(min(max_order+1, n_turns)):
+        ends[j:] += turns[:n_turns-j] * b**j
+    
+    conv = np.repeat(np.arange(n_convs), np.diff(offsets))
+    rel = np.arange(n_turns) - offsets[conv] # Position within the conversation
+    is_last = rel == np.diff(offsets)[conv] - 1
+    keep = np.ones(n_turns, dtype=bool) if mask is None else np.asarray(mask, dtype=bool)
+    
+    # The one full scan: windows ending on each selected turn
+    is_full = keep & (rel >= max_order)
+    full = np.bincount(conv[is_full]*n_full + ends[is_full], 
+                       minlength=n_convs*n_full).reshape(n_convs, n_full)
+    
+    # Windows ending on the final turn of a conversation are never counted, 
+    # and windows ending before turn max_order are missing from the table
+    i_tail = np.flatnonzero(is_full & is_last)
+    i_head = np.flatnonzero(keep & (rel < max_order) & ~is_last)
+    
+    counts = {}
+    for k in range(1, max_order+1):
+        marginals = []
+        for (n_bits, first) in ((k, k-1), (k+1, k)): # States, then transitions
+            n_codes = b**n_bits
+            i_add = i_head[rel[i_head] >= first]
+            marginal = full.reshape(n_convs, -1, n_codes).sum(axis=1)
+            marginal += np.bincount(conv[i_add]*n_codes + ends[i_add] % n_codes, 
+                                    minlength=n_convs*n_codes).reshape(n_convs, n_codes)
+            marginal -= np.bincount(conv[i_tail]*n_codes + ends[i_tail] % n_codes, 
+                                    minlength=n_convs*n_codes).reshape(n_convs, n_codes)
+            marginals.append(marginal)
+        
+        # Reorder transitions from oldest-turn-first to the trans_order layout
+        codes = np.arange(b**(k+1))
+        counts[k] = (marginals[0], marginals[1][:, (codes % b**k)*b + codes // b**k])
+    return(counts)
+
+def codym_multi_order(turn_lengths, max_order, *mask, n_levels=2):
+    """Build CODYMs of every order 1..max_order from a single counting pass
+    
+    Inputs:
+        turn_lengths - the list of binarized turn lengths
+        max_order - the highest order of CODYM to build
+        mask - a logical mask of turns to be included in the CODYMs
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        dict mapping each order to its CODYM, each identical to CODYM(turn_lengths, order, *mask)
+    Example call:
+        codym_multi_order(list(np.random.randint(0,2,100)), 3)
+    """
+    
+    if len(mask) and not len(mask[0]):
+        print('Mask contains no selected turns, being ignored')
+    mask = mask[0] if len(mask) and len(mask[0]) else None
+    counts = codym_counts_multi_order(turn_lengths, [0, len(turn_lengths)], max_order, mask, n_levels)
+    
+    return({k: _from_counts(turn_lengths, k, states_counts[0], trans_counts[0], n_levels=n_levels) 
+            for (k, (states_counts, trans_counts)) in counts.items()})
+
+def codym_multi_mask(turn_lengths, model_order, masks, sparse=False, n_levels=2):
+    """Build one CODYM per mask (or per label) from a single counting pass
+    
+    Each state and transition is counted under a combined (group, code) key 
+    with a single bincount. Masks select states by their last turn and 
+    transitions by their new turn, exactly as the mask of CODYM.
+    
+    Inputs:
+        turn_lengths - the list of binarized turn lengths
+        model_order - the order of the CODYM models
+        masks - either a 2D logical matrix with one mask (row) per CODYM, or
+                a vector with a group label for each turn (negative numeric 
+                labels are excluded from every CODYM)
+        sparse - build sparse CODYMs
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        list of CODYMs, one per row of a mask matrix, or a dict mapping each
+        label to its CODYM
+    Example call:
+        codym_multi_mask(turn_lengths, 3, [speaker == 0, speaker == 1])
+        codym_multi_mask(turn_lengths, 3, speaker)
+    """
+    
+    turns = np.asarray(turn_lengths, dtype=np.int64)
+    masks = np.asarray(masks)
+    n_codes = n_levels**model_order
+    n_trans_codes = n_levels*n_codes
+    _check_levels(turns, n_levels)
+    _check_order(model_order, n_levels)
+    if masks.ndim not in (1, 2) or masks.shape[-1] != len(turns):
+        raise ValueError('masks must be a vector or matrix with one entry per turn (' + str(len(turns)) + ')')
+    
+    n_states = max(len(turns) - model_order, 0)
+    n_trans = max(n_states - 1, 0)
+    states = _window_codes(turns, model_order, n_states, n_levels)
+    transitions = _trans_codes(turns, states, model_order, n_trans, n_levels)
+    
+    if masks.ndim == 2:
+        labels = None
+        n_groups = len(masks)
+        masks = masks.astype(bool)
+        group_s, i_s = np.nonzero(masks[:, model_order-1:model_order-1+n_states])
+        group_t, i_t = np.nonzero(masks[:, model_order:model_order+n_trans])
+    else:
+        labels, masks = np.unique(masks, return_inverse=True)
+        n_groups = len(labels)
+        # Negative numbers exclude turns; any other label (e.g. a string) is a group
+        keep = labels >= 0 if np.issubdtype(labels.dtype, np.number) else np.ones(n_groups, dtype=bool)
+        i_s = np.flatnonzero(keep[masks[model_order-1:model_order-1+n_states]])
+        i_t = np.flatnonzero(keep[masks[model_order:model_order+n_trans]])
+        group_s = masks[model_order-1:][i_s]
+        group_t = masks[model_order:][i_t]
+    
+    state_keys = group_s*n_codes + states[i_s]
+    trans_keys = group_t*n_trans_codes + transitions[i_t]
+    codyms = []
+    if sparse:
+        state_keys, states_counts = np.unique(state_keys, return_counts=True)
+        trans_keys, trans_counts = np.unique(trans_keys, return_counts=True)
+        s_bounds = np.searchsorted(state_keys, np.arange(n_groups+1)*n_codes)
+        t_bounds = np.searchsorted(trans_keys, np.arange(n_groups+1)*n_trans_codes)
+        for g in range(n_groups):
+            s, t = slice(s_bounds[g], s_bounds[g+1]), slice(t_bounds[g], t_bounds[g+1])
+            codyms.append(_from_counts(turn_lengths, model_order, states_counts[s], trans_counts[t],
+                                       state_keys[s] - g*n_codes, trans_keys[t] - g*n_trans_codes,
+                                       n_levels))
+    else:
+        states_counts = np.bincount(state_keys, minlength=n_groups*n_codes).reshape(n_groups, -1)
+        trans_counts = np.bincount(trans_keys, minlength=n_groups*n_trans_codes).reshape(n_groups, -1)
+        for g in range(n_groups):
+            codyms.append(_from_counts(turn_lengths, model_order, states_counts[g], trans_counts[g],
+                                       n_levels=n_levels))
+    
+    if labels is None:
+        return(codyms)
+    return({label: c for (label, c, k) in zip(labels, codyms, keep) if k})
+
+def codym_obs(counts):
+    """Normalize each row of a count matrix to frequencies (all 0 if empty)"""
+    
+    counts = np.asarray(counts)
+    totals = counts.sum(axis=-1, keepdims=True)
+    return np.divide(counts, totals, out=np.zeros(counts.shape), where=totals!=0)
+
+def codym_avg_counts(states_counts, trans_counts, model_order, n_levels=2):
+    """Average the per-conversation CODYMs in a pair of count matrices
+    
+    Equivalent to codym_avg over one CODYM per row of codym_counts output,
+    without building the individual CODYMs.
+    """
+    
+    c_new = CODYM([], model_order, n_levels=n_levels)
+    c_new.states_obs = codym_obs(states_counts).mean(axis=0).tolist()
+    c_new.trans_obs = codym_obs(trans_counts).mean(axis=0).tolist()
+    c_new.states_counts = np.asarray(states_counts).sum(axis=0)
+    c_new.trans_counts = np.asarray(trans_counts).sum(axis=0)
+    c_new.n_convs = len(states_counts)
+    return(c_new)
+
+def joint_turns(turn_lengths, speakers, n_levels=2):
+    """Symbols of the joint speaker x length alphabet: speaker*n_levels + length
+    
+    Inputs:
+        turn_lengths - turn lengths, binned into 0..n_levels-1
+        speakers - integer speaker id (0, 1, ...) of each turn
+        n_levels - the number of turn length bins
+    """
+    
+    return np.asarray(speakers, dtype=np.int64)*n_levels + np.asarray(turn_lengths, dtype=np.int64)
+
+def codym_joint(turn_lengths, speakers, model_order, *mask, n_levels=2, n_speakers=None, sparse=True):
+    """Build a CODYM over the joint alphabet of speaker and turn length
+    
+    States record who spoke each turn as well as its length, so one build 
+    captures who-speaks-when; length CODYMs, including per-speaker masked 
+    ones, are recovered with CODYM.marginalize. Sparse by default, since only
+    a fraction of the (n_speakers*n_levels)^model_order states usually occur.
+    For many conversations, count joint_turns(...) with codym_counts
+    (n_levels=n_speakers*n_levels) and reduce the rows with codym_marginal_counts.
+    
+    Inputs:
+        turn_lengths - the list of binarized turn lengths
+        speakers - integer speaker id (0, 1, ...) of each turn
+        model_order - the order of the CODYM model
+        mask - a logical mask of turns to be included in the CODYM
+        n_levels - the number of turn length bins
+        n_speakers - the number of speakers (default: largest id + 1)
+        sparse - as for CODYM
+    Example call:
+        joint = codym_joint(turn_lengths, speaker, 3)
+    """
+    
+    speakers = np.asarray(speakers, dtype=np.int64)
+    if n_speakers is None:
+        n_speakers = int(speakers.max()) + 1 if len(speakers) else 1
+    return CODYM(joint_turns(turn_lengths, speakers, n_levels), model_order, *mask, 
+                 sparse=sparse, n_levels=n_speakers*n_levels)
+
+def codym_marginal_counts(states_counts, trans_counts, model_order, n_levels_joint, n_levels=2, speakers=None):
+    """Reduce per-conversation joint speaker x length counts to length counts
+    
+    Row-wise version of CODYM.marginalize, for count matrices from codym_counts
+    of joint_turns. Each row matches the length counts of its conversation, 
+    masked by speaker if speakers are given.
+    
+    Inputs:
+        states_counts, trans_counts - joint count matrices, one row per conversation
+        model_order - the order of the CODYM models
+        n_levels_joint - the number of joint symbols (n_speakers*n_levels)
+        n_levels - the number of turn length bins
+        speakers - optional list of speaker ids to keep
+    Returns:
+        states_counts, trans_counts - length count matrices
+    Example call:
+        joint = codym_counts(joint_turns(turn_lengths, speaker), offsets, 3, n_levels=4)
+        states_counts, trans_counts = codym_marginal_counts(*joint, 3, 4, 2, [0])
+    """
+    
+    marginals = []
+    for (counts, n_digits, last) in [(states_counts, model_order, model_order-1), 
+                                     (trans_counts, model_order+1, 0)]:
+        counts = np.asarray(counts)
+        keep, new_codes = _marginal_codes(np.arange(counts.shape[1]), n_digits, n_levels_joint,
+                                          n_levels, speakers, last)
+        marginal = np.zeros((len(counts), n_levels**n_digits), dtype=counts.dtype)
+        np.add.at(marginal.T, new_codes, counts[:, keep].T)
+        marginals.append(marginal)
+    return(marginals[0], marginals[1])
+
+def _prefix_counts(codes, weights, n_codes):
+    """Cumulative one-hot counts: row i holds the counts of codes[:i]"""
+    
+    prefix = np.zeros((len(codes)+1, n_codes), dtype=np.int64)
+    prefix[np.arange(1, len(codes)+1), codes] = weights
+    return np.cumsum(prefix, axis=0, out=prefix)
+
+def codym_rolling(turn_lengths, model_order, window, stride=1, *, mask=None, n_levels=2):
+    """Count the states and transitions of each rolling window of a conversation
+    
+    Row j of the outputs holds the counts that 
+    CODYM(turn_lengths[s:s+window], model_order, mask[s:s+window]) is built 
+    from, for s = j*stride. Each state and transition is coded once, and the 
+    counts of every window are differences of cumulative one-hot counts, so 
+    the cost does not grow with the window size.
+    
+    Inputs:
+        turn_lengths - the list of binarized turn lengths
+        model_order - the order of the CODYM models
+        window - the number of turns in each window
+        stride - the number of turns between the starts of consecutive windows
+        mask - optional logical mask of turns to be included in the CODYMs
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        states_counts - (n_windows x n_levels^model_order) array of state counts
+        trans_counts - (n_windows x n_levels^(model_order+1)) array of transition counts
+        Windows start at turns 0, stride, 2*stride, ..., up to the last one that 
+        fits in the conversation; use codym_obs to normalize.
+    Example call:
+        states_counts, trans_counts = codym_rolling(turn_lengths, 3, 50, 10, mask=is_patient)
+    """
+    
+    turns = np.asarray(turn_lengths, dtype=np.int64)
+    _check_levels(turns, n_levels)
+    _check_order(model_order, n_levels)
+    n_states = max(len(turns) - model_order, 0)
+    n_trans = max(n_states - 1, 0)
+    states = _window_codes(turns, model_order, n_states, n_levels)
+    transitions = _trans_codes(turns, states, model_order, n_trans, n_levels)
+    
+    # As in CODYM, a state is selected by its last turn, a transition by its new turn
+    if mask is not None and len(mask):
+        mask = np.asarray(mask, dtype=np.int64)
+        state_weights = mask[model_order-1:model_order-1+n_states]
+        trans_weights = mask[model_order:model_order+n_trans]
+    else:
+        state_weights, trans_weights = 1, 1
+    state_prefix = _prefix_counts(states, state_weights, n_levels**model_order)
+    trans_prefix = _prefix_counts(transitions, trans_weights, n_levels**(model_order+1))
+    
+    # Window s:s+window holds the states starting at s..s+window-model_order-1
+    # and one fewer transition
+    starts = np.arange(0, len(turns) - window + 1, stride)
+    n_in = max(window - model_order, 0)
+    state_ends = np.minimum(starts + n_in, n_states)
+    trans_ends = np.minimum(starts + max(n_in - 1, 0), n_trans)
+    states_counts = state_prefix[state_ends] - state_prefix[np.minimum(starts, state_ends)]
+    trans_counts = trans_prefix[trans_ends] - trans_prefix[np.minimum(starts, trans_ends)]
+    return(states_counts, trans_counts)
+
+def codym_conditional(trans, model_order, n_levels=2):
+    """Probability of each next turn length given each state
+    
+    Works on one transition vector or a whole stack of them (e.g. the 
+    trans_counts of codym_counts), in one array operation. Transition code 
+    x*n_levels^model_order + s is state s followed by a turn of length bin x, 
+    so the transitions reshape to (..., n_levels, n_states) and are normalized
+    over the length bins. States never left (no transitions) are given 
+    uniform probabilities.
+    
+    Inputs:
+        trans - transition counts or frequencies, (... x n_levels^(model_order+1))
+        model_order - the order of the CODYM models
+        n_levels - the number of turn length bins
+    Returns:
+        (... x n_states x n_levels) array of P(next turn length | state)
+    """
+    
+    trans = np.asarray(trans, dtype=float)
+    n_states = n_levels**model_order
+    joint = np.swapaxes(trans.reshape(trans.shape[:-1] + (n_levels, n_states)), -1, -2)
+    totals = joint.sum(axis=-1, keepdims=True)
+    return np.divide(joint, totals, out=np.full(joint.shape, 1/n_levels), where=totals > 0)
+
+def codym_transition_matrix(trans, model_order, n_levels=2):
+    """Conditional state-to-state transition matrix of one or a stack of CODYMs
+    
+    State s moves to state (s*n_levels + x) mod n_levels^model_order when 
+    followed by a turn of length bin x; all other entries are 0.
+    
+    Inputs:
+        trans, model_order, n_levels - as for codym_conditional
+    Returns:
+        (... x n_states x n_states) array, rows summing to 1
+    Example call:
+        CODYM(list(np.random.randint(0,2,100)), 2).transition_matrix()
+    """
+    
+    return _transition_matrix(codym_conditional(trans, model_order, n_levels))
+
+def _transition_matrix(cond):
+    """State-to-state matrices from (... x n_states x n_levels) conditional probabilities"""
+    
+    n_states, n_levels = cond.shape[-2:]
+    matrix = np.zeros(cond.shape[:-1] + (n_states,))
+    states = np.arange(n_states)
+    for x in range(n_levels):
+        matrix[..., states, (states*n_levels + x) % n_states] += cond[..., x]
+    return(matrix)
+
+def _stationary_step(pi, cond, n_levels):
+    """One step pi P of the chain, from (... x n_states x n_levels) conditional probabilities"""
+    
+    # The flat index s*n_levels + x of (state, next length) is 
+    # r*n_states + (next state), so summing over r gives the next state
+    n_states = cond.shape[-2]
+    return((pi[..., None] * cond).reshape(pi.shape[:-1] + (n_levels, n_states)).sum(axis=-2))
+
+def _stationary_power(cond, n_levels, n_iter=10000, tol=1e-12):
+    """Stationary distributions by power iteration on the lazy chain (I + P)/2"""
+    
+    n_states = cond.shape[-2]
+    pi = np.full(cond.shape[:-1], 1/n_states)
+    for _ in range(n_iter):
+        new_pi = (pi + _stationary_step(pi, cond, n_levels)) / 2
+        if np.max(np.abs(new_pi - pi), initial=0) < tol:
+            return(new_pi)
+        pi = new_pi
+    return(pi)
+
+def codym_stationary(trans, model_order, n_levels=2, chunk_size=2**24):
+    """Stationary distribution over states of one or a stack of CODYMs
+    
+    Solves pi (P - I) = 0 with one equation replaced by sum(pi) = 1, for the 
+    whole stack with batched np.linalg.solve (in chunks of about chunk_size 
+    matrix entries, to bound memory). Chains without a unique stationary 
+    distribution (more than one closed class) make this system singular 
+    (detected by its condition number); those are found by power iteration on the lazy chain instead, whose 
+    result depends on the (uniform) starting distribution.
+    
+    Inputs:
+        trans, model_order, n_levels - as for codym_conditional
+        chunk_size - the number of matrix entries solved at a time
+    Returns:
+        (... x n_states) array of stationary state probabilities
+    """
+    
+    cond = codym_conditional(trans, model_order, n_levels)
+    n_states = n_levels**model_order
+    shape = cond.shape[:-1]
+    cond = cond.reshape((-1, n_states, n_levels))
+    pi = np.zeros((len(cond), n_states))
+    
+    # Right-hand side: 0 for each balance equation, 1 for the normalization
+    rhs = np.zeros(n_states)
+    rhs[-1] = 1
+    step = max(chunk_size // n_states**2, 1)
+    for start in range(0, len(cond), step):
+        block = cond[start:start+step]
+        # Rows are equations (P^T - I) pi = 0, the last replaced by sum(pi) = 1
+        system = np.swapaxes(_transition_matrix(block), -1, -2)
+        system -= np.eye(n_states)
+        system[:, -1, :] = 1
+        # Singular systems are solved as identities here and redone below
+        singular = np.linalg.cond(system) > 1e10
+        system[singular] = np.eye(n_states)
+        pi[start:start+step] = np.linalg.solve(system, np.broadcast_to(rhs, (len(block), n_states))[..., None])[..., 0]
+        pi[start:start+step][singular] = np.nan
+    
+    # Chains without a unique solution fall back to power iteration
+    bad = ~np.all(np.isfinite(pi) & (pi > -1e-9), axis=1)
+    if np.any(bad):
+        pi[bad] = _stationary_power(cond[bad], n_levels)
+    return(np.clip(pi, 0, None).reshape(shape))
+
+def codym_entropy_rate(trans, model_order, n_levels=2):
+    """Entropy rate (bits per turn) of one or a stack of CODYMs
+    
+    The entropy of the next turn length given the current state, averaged 
+    over the stationary distribution: H = -sum_s pi(s) sum_x P(x|s) log2 P(x|s).
+    
+    Inputs:
+        trans, model_order, n_levels - as for codym_conditional
+    Returns:
+        the entropy rate, or an array with one per CODYM of a stack
+    Example call:
+        codym_entropy_rate(trans_counts, 3) # One per conversation
+    """
+    
+    cond = codym_conditional(trans, model_order, n_levels)
+    pi = codym_stationary(trans, model_order, n_levels)
+    h_state = -np.sum(cond * np.log2(np.where(cond > 0, cond, 1)), axis=-1)
+    return np.sum(pi * h_state, axis=-1)
@@ -0,0 +1,199 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Benchmarks of CODYM construction, aggregation and rendering on synthetic
+# corpora. Run from the command line, e.g.
+#
+#   python CODYM_benchmark.py --save-baseline baseline.json
+#   python CODYM_benchmark.py --baseline baseline.json --tolerance 0.25
+#
+# Each benchmark records its wall time (best of --repeats runs), peak traced
+# memory (tracemalloc, in a separate run), the process's peak RSS so far, and
+# throughput in turns per second. Results are written as JSON; with
+# --baseline, any benchmark slower than the baseline by more than the
+# tolerance is reported and the script exits with status 1.
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+import numpy as np
+
+from CODYM import CODYM, codym_avg, codym_counts, codym_avg_counts, _from_counts
+from CODYM_simulate import codym_simulate
+
+try:
+    import resource
+except ImportError: # Not available on Windows
+    resource = None
+
+BENCHMARKS = ('codym_init', 'codym_counts', 'codym_avg', 'codym_sub', 'draw_codym')
+CONV_TURNS = 100 # Mean turns per synthetic conversation
+
+def _peak_rss_mb():
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == 'darwin' else rss / 2**10 # bytes on macOS, KB elsewhere
+
+def synthetic_corpus(n_turns, model_order, seed=0):
+    """A synthetic corpus of about n_turns turns, from a random CODYM of model_order"""
+
+    rng = np.random.default_rng(seed)
+    reference = CODYM(list(rng.integers(0, 2, 10*2**(model_order+1) + model_order)), model_order)
+    n_convs = max(n_turns // CONV_TURNS, 1)
+    lengths = rng.multinomial(n_turns - n_convs*(n_turns//n_convs), np.full(n_convs, 1/n_convs))
+    lengths += n_turns // n_convs
+    turns, offsets = codym_simulate(reference, n_convs, lengths, seed=seed)
+    mask = rng.random(len(turns)) < 0.5
+    return turns, offsets, mask
+
+def _setup(name, turns, offsets, mask, model_order):
+    """The function timed by a benchmark, with its inputs prepared outside the timing"""
+
+    mask_args = () if mask is None else (list(mask),)
+    if name == 'codym_init':
+        turn_list = list(turns)
+        return lambda: CODYM(turn_list, model_order, *mask_args)
+    if name == 'codym_counts':
+        return lambda: codym_counts(turns, offsets, model_order, mask)
+    states_counts, trans_counts = codym_counts(turns, offsets, model_order, mask)
+    if name == 'codym_avg':
+        clist = [_from_counts([], model_order, s, t) for (s, t) in zip(states_counts, trans_counts)]
+        return lambda: codym_avg(clist)
+    half = len(states_counts) // 2
+    c1 = codym_avg_counts(states_counts[:half], trans_counts[:half], model_order)
+    c2 = codym_avg_counts(states_counts[half:], trans_counts[half:], model_order)
+    if name == 'codym_sub':
+        return lambda: c1 - c2
+    if name == 'draw_codym':
+        import matplotlib
+        matplotlib.use('Agg')
+        from matplotlib import pyplot as plt
+        from draw_CODYM import draw_codym
+        def draw():
+            draw_codym(c1 - c2, True)
+            plt.close('all')
+        return draw
+    raise ValueError('Unknown benchmark ' + name)
+
+def run_benchmark(name, n_turns, model_order, masked, repeats=3, seed=0):
+    """Run one benchmark; returns its result record"""
+
+    turns, offsets, mask = synthetic_corpus(n_turns, model_order, seed)
+    fun = _setup(name, turns, offsets, mask if masked else None, model_order)
+    record = {'name': name, 'n_turns': int(n_turns), 'model_order': model_order, 'masked': masked}
+    try:
+        times = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            fun()
+            times.append(time.perf_counter() - start)
+        tracemalloc.start()
+        fun()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    except Exception as e:
+        tracemalloc.stop()
+        record['error'] = repr(e)
+        return record
+    record['time_s'] = min(times)
+    record['peak_mb'] = peak / 2**20
+    record['rss_mb'] = _peak_rss_mb()
+    record['turns_per_s'] = n_turns / min(times) if min(times) > 0 else None
+    return record
+
+def run_all(benchmarks, sizes, orders, masks=(False, True), repeats=3, max_list_turns=10**7, seed=0,
+            verbose=True):
+    """Run every combination of benchmark, corpus size, model order and masking"""
+
+    results = []
+    for name in benchmarks:
+        for n_turns in sizes:
+            # CODYM takes a list of turns, and codym_avg one CODYM object per
+            # conversation; both are too large for the biggest corpora
+            if name in ('codym_init', 'codym_avg') and n_turns > max_list_turns:
+                continue
+            for model_order in orders:
+                # The drawing functions only handle 2nd and 3rd order CODYMs
+                if name == 'draw_codym' and model_order not in (2, 3):
+                    continue
+                for masked in masks:
+                    record = run_benchmark(name, n_turns, model_order, masked, repeats, seed)
+                    results.append(record)
+                    if verbose:
+                        print(_format(record))
+    return results
+
+def _format(record):
+    head = '{name:13s} n={n_turns:<10d} k={model_order} mask={masked!s:5s}'.format(**record)
+    if 'error' in record:
+        return head + ' error: ' + record['error']
+    return head + ' {time_s:10.4f}s {peak_mb:9.1f}MB {turns_per_s:12.3g} turns/s'.format(**record)
+
+def _key(record):
+    return (record['name'], record['n_turns'], record['model_order'], record['masked'])
+
+def compare(results, baseline, tolerance=0.2, min_seconds=1e-3):
+    """Benchmarks slower than the baseline by more than tolerance (a fraction)
+
+    Slowdowns of less than min_seconds are ignored, as timer noise.
+    Returns a list of (result, baseline result) pairs of regressions.
+    """
+
+    base = {_key(r): r for r in baseline['results'] if 'time_s' in r}
+    regressions = []
+    for r in results:
+        b = base.get(_key(r))
+        if b is not None and 'time_s' in r and r['time_s'] > b['time_s'] * (1 + tolerance) \
+                and r['time_s'] - b['time_s'] > min_seconds:
+            regressions.append((r, b))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark CODYM construction, aggregation and rendering')
+    parser.add_argument('--benchmarks', nargs='+', default=list(BENCHMARKS), choices=BENCHMARKS)
+    parser.add_argument('--sizes', nargs='+', type=float, default=[1e3, 1e4, 1e5, 1e6],
+                        help='corpus sizes in turns (up to 1e8)')
+    parser.add_argument('--orders', nargs='+', type=int, default=[1, 2, 3, 5, 8])
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--max-list-turns', type=float, default=1e7,
+                        help='largest corpus for codym_init and codym_avg, which use Python lists')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='codym_benchmark.json', help='results file')
+    parser.add_argument('--save-baseline', help='also save the results as a baseline file')
+    parser.add_argument('--baseline', help='baseline file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='allowed slowdown relative to the baseline (0.2 = 20%%)')
+    args = parser.parse_args(argv)
+
+    results = run_all(args.benchmarks, [int(s) for s in args.sizes], args.orders,
+                      repeats=args.repeats, max_list_turns=args.max_list_turns, seed=args.seed)
+    output = {'meta': {'python': platform.python_version(), 'numpy': np.__version__,
+                       'platform': platform.platform(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')},
+              'results': results}
+    for path in [args.output, args.save_baseline]:
+        if path:
+            with open(path, 'w') as f:
+                json.dump(output, f, indent=1)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for (r, b) in regressions:
+            print('REGRESSION ' + _format(r) + ' (baseline {:.4f}s)'.format(b['time_s']))
+        if regressions:
+            return 1
+        print('No regressions beyond ' + str(args.tolerance))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,232 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Binarization of turn lengths without concatenating a corpus in memory.
+# Thresholds are estimated with mergeable quantile sketches, and conversations
+# are binarized and counted as they stream past.
+
+import numpy as np
+
+from CODYM import codym_counts
+
+# Key of the bucket holding zero (and negligibly small) lengths in a sketch
+_ZERO = np.iinfo(np.int64).min
+
+class QuantileSketch():
+
+    def __init__(self, relative_accuracy=0.01, exact=False):
+        """Mergeable streaming sketch of the distribution of turn lengths
+
+        Lengths are counted in logarithmic buckets (as in DDSketch), so any
+        quantile is estimated to within relative_accuracy of a true value,
+        using memory that grows only with the log of the range of lengths.
+        In exact mode, each distinct length is counted instead, which gives
+        the same quantiles as np.quantile and is still compact for integer
+        lengths such as word counts.
+
+        Inputs:
+            relative_accuracy - relative error of estimated quantiles
+            exact - count distinct values instead of buckets
+        Example call:
+            sketch = QuantileSketch()
+            for conv in convs:
+                sketch.add(conv)
+            t = np.round(sketch.quantile(0.5))
+        """
+
+        if not 0 < relative_accuracy < 1:
+            raise ValueError('relative_accuracy must be between 0 and 1')
+        self.relative_accuracy = relative_accuracy
+        self.exact = exact
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.keys = np.zeros(0, dtype=float if exact else np.int64) # Sorted
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.counts.sum())
+
+    def _key(self, values):
+        if self.exact:
+            return values
+        keys = np.full(len(values), _ZERO, dtype=np.int64)
+        pos = values > 1e-9
+        keys[pos] = np.ceil(np.log(values[pos]) / np.log(self.gamma))
+        return keys
+
+    def _value(self, keys):
+        if self.exact:
+            return keys
+        # Bucket i holds (gamma^(i-1), gamma^i]; its midpoint in relative terms
+        return np.where(keys == _ZERO, 0.0, 2 * self.gamma**np.maximum(keys, -1000) / (self.gamma + 1))
+
+    def _combine(self, keys, counts):
+        self.keys, i_key = np.unique(np.concatenate((self.keys, keys)), return_inverse=True)
+        self.counts = np.bincount(i_key, np.concatenate((self.counts, counts)),
+                                  minlength=len(self.keys)).astype(np.int64)
+
+    def add(self, values):
+        """Add an array of turn lengths to the sketch; returns the sketch"""
+
+        values = np.asarray(values, dtype=float).ravel()
+        if np.any(values < 0):
+            raise ValueError('Turn lengths must be non-negative')
+        keys, counts = np.unique(self._key(values), return_counts=True)
+        self._combine(keys, counts)
+        return self
+
+    def merge(self, other):
+        """Add the lengths of another sketch (e.g. from another worker) to this one; returns the sketch"""
+
+        if other.exact != self.exact or (not self.exact and other.gamma != self.gamma):
+            raise ValueError('Only sketches with the same accuracy can be merged')
+        self._combine(other.keys, other.counts)
+        return self
+
+    def quantile(self, q):
+        """Estimated q-th quantile(s) of the lengths, interpolated as np.quantile"""
+
+        n = len(self)
+        if n == 0:
+            raise ValueError('Cannot take a quantile of an empty sketch')
+        rank = np.asarray(q, dtype=float) * (n - 1)
+        cum = np.cumsum(self.counts)
+        lo = self._value(self.keys[np.searchsorted(cum, np.floor(rank), side='right')])
+        hi = self._value(self.keys[np.searchsorted(cum, np.ceil(rank), side='right')])
+        return lo + (hi - lo) * (rank - np.floor(rank))
+
+def _conversation(conv):
+    """(turn lengths, speakers, mask) of a conversation given as lengths or a tuple"""
+
+    if isinstance(conv, tuple):
+        conv = conv + (None,) * (3 - len(conv))
+        return (np.asarray(conv[0]),) + conv[1:]
+    return (np.asarray(conv), None, None)
+
+def sketch_lengths(convs, per_speaker=False, relative_accuracy=0.01, exact=False):
+    """Sketch the turn lengths of a stream of conversations, in one pass
+
+    Inputs:
+        convs - iterable of conversations, each an array of turn lengths or a
+                tuple (turn lengths, speakers[, mask]); masks are ignored, since
+                masked-out turns are still binarized as part of windows
+        per_speaker - keep a separate sketch for each speaker
+        relative_accuracy, exact - as for QuantileSketch
+    Returns:
+        a QuantileSketch, or a dict mapping each speaker to its QuantileSketch
+    Example call:
+        sketches = sketch_lengths(zip(convs, speakers), per_speaker=True)
+        thresholds = {s: np.round(sketch.quantile(0.5)) for (s, sketch) in sketches.items()}
+    """
+
+    sketches = {}
+    for conv in convs:
+        lengths, speakers, mask = _conversation(conv)
+        if per_speaker:
+            speakers = np.asarray(speakers)
+            for s in np.unique(speakers):
+                sketches.setdefault(s, QuantileSketch(relative_accuracy, exact)).add(lengths[speakers == s])
+        else:
+            sketches.setdefault(None, QuantileSketch(relative_accuracy, exact)).add(lengths)
+    if per_speaker:
+        return(sketches)
+    return sketches.get(None, QuantileSketch(relative_accuracy, exact))
+
+def quantile_thresholds(sketch, n_levels):
+    """Thresholds splitting the lengths in a sketch into n_levels equally frequent bins"""
+    return sketch.quantile(np.arange(1, n_levels) / n_levels)
+
+def _n_levels(threshold):
+    """Number of bins given by a threshold, a list of thresholds, or a dict of either"""
+
+    if isinstance(threshold, dict):
+        threshold = next(iter(threshold.values()), 0)
+    return len(np.atleast_1d(threshold)) + 1
+
+def binarize(turn_lengths, threshold, speakers=None):
+    """Binarize turn lengths: 1 (long) if at least the threshold, else 0 (short)
+
+    Given a sorted list of thresholds, lengths are binned into 0..len(threshold)
+    instead, by the number of thresholds they are at least.
+
+    Inputs:
+        turn_lengths - array of turn lengths
+        threshold - a single threshold or list of thresholds, or a dict mapping
+                    each speaker to its threshold(s)
+        speakers - speaker of each turn (for per-speaker thresholds)
+    Example call:
+        binarize(n_words, quantile_thresholds(sketch, 3)) # Short/medium/long
+    """
+
+    turn_lengths = np.asarray(turn_lengths)
+    if not isinstance(threshold, dict):
+        return np.digitize(turn_lengths, np.atleast_1d(threshold)).astype(np.uint8)
+    ids, i_speaker = np.unique(np.asarray(speakers), return_inverse=True)
+    levels = np.zeros(len(turn_lengths), dtype=np.uint8)
+    for (i, s) in enumerate(ids.tolist()):
+        is_speaker = i_speaker == i
+        levels[is_speaker] = np.digitize(turn_lengths[is_speaker], np.atleast_1d(threshold[s]))
+    return(levels)
+
+def binarized_counts(convs, model_order, threshold=None, q=0.5, chunk_turns=2**20):
+    """Binarize and count a stream of conversations, without concatenating the corpus
+
+    Conversations are binarized as they arrive and counted with codym_counts
+    about chunk_turns turns at a time, so only one chunk is held in memory.
+
+    Inputs:
+        convs - iterable of conversations, each an array of turn lengths or a
+                tuple (turn lengths, speakers[, mask])
+        model_order - the order of the CODYM models
+        threshold - a global threshold, a dict of per-speaker thresholds (e.g.
+                    from sketch_lengths), or None for a threshold per conversation;
+                    lists of thresholds give multi-level CODYMs, as for binarize
+        q - the quantile(s) of each conversation's lengths used when threshold is None
+        chunk_turns - the approximate number of turns counted at a time
+    Returns:
+        states_counts, trans_counts - count matrices, one row per conversation
+    Example call:
+        t = np.round(sketch_lengths(convs).quantile(0.5))
+        states_counts, trans_counts = binarized_counts(convs, 3, t)
+    """
+
+    n_levels = _n_levels(q if threshold is None else threshold)
+    states_blocks, trans_blocks = [], []
+    chunk = []
+
+    def flush():
+        if not chunk:
+            states_blocks.append(np.zeros((0, n_levels**model_order), dtype=np.int64))
+            trans_blocks.append(np.zeros((0, n_levels**(model_order+1)), dtype=np.int64))
+            return
+        lengths = [c[0] for c in chunk]
+        offsets = np.concatenate(([0], np.cumsum([len(l) for l in lengths])))
+        masks = [np.ones(len(c[0]), dtype=bool) if c[1] is None else c[1] for c in chunk]
+        has_mask = any(c[1] is not None for c in chunk)
+        sc, tc = codym_counts(np.concatenate(lengths), offsets, model_order,
+                              np.concatenate(masks) if has_mask else None, n_levels)
+        states_blocks.append(sc)
+        trans_blocks.append(tc)
+        chunk.clear()
+
+    n_turns = 0
+    for conv in convs:
+        lengths, speakers, mask = _conversation(conv)
+        if threshold is None:
+            t = np.quantile(lengths, q) if len(lengths) else np.zeros(np.shape(q))
+        else:
+            t = threshold
+        chunk.append((binarize(lengths, t, speakers),
+                      None if mask is None else np.asarray(mask, dtype=bool)))
+        n_turns += len(lengths)
+        if n_turns >= chunk_turns:
+            flush()
+            n_turns = 0
+    if chunk or not states_blocks:
+        flush()
+    return(np.vstack(states_blocks), np.vstack(trans_blocks))
@@ -0,0 +1,118 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Clustering of conversations into archetypes by their transition frequencies.
+
+import numpy as np
+
+from CODYM import CODYM, codym_obs
+from CODYM_distance import codym_distances
+
+def _rows(counts, idx):
+    """Frequencies of the rows idx of a count matrix (idx sorted, for memmap locality)"""
+    return codym_obs(np.asarray(counts[idx], dtype=np.int64))
+
+def _init_centroids(obs, n_clusters, metric, rng):
+    """k-means++ seeding: each centroid is drawn with probability ~ squared distance"""
+
+    centroids = [obs[rng.integers(len(obs))]]
+    d2 = codym_distances(obs, np.array(centroids), metric, n_jobs=1)[:, 0]**2
+    for _ in range(1, n_clusters):
+        p = d2 / d2.sum() if d2.sum() > 0 else np.full(len(obs), 1/len(obs))
+        centroids.append(obs[rng.choice(len(obs), p=p)])
+        d2 = np.minimum(d2, codym_distances(obs, centroids[-1][None, :], metric, n_jobs=1)[:, 0]**2)
+    return np.array(centroids)
+
+def codym_kmeans(states_counts, trans_counts, model_order, n_clusters, metric='js', batch_size=1024,
+                 n_iter=100, tol=1e-4, seed=None, chunk_rows=2**16, n_jobs=None, n_levels=2):
+    """Cluster conversations by their transition frequencies with mini-batch k-means
+
+    Each iteration reads a random batch of conversations, assigns each to its
+    nearest centroid under metric, and moves the centroids towards the mean
+    of their assigned conversations with a per-centroid learning rate (as in
+    mini-batch k-means), stopping once no centroid moves more than tol.
+    Only batches are read, so the count matrices can be memory-mapped (e.g.
+    np.load(..., mmap_mode='r') or CODYMCorpus.counts saved with np.save).
+    A final pass, chunk_rows conversations at a time, labels every
+    conversation and averages each cluster.
+
+    Inputs:
+        states_counts, trans_counts - per-conversation count matrices (from codym_counts)
+        model_order - the order of the CODYM models
+        n_clusters - the number of clusters
+        metric - distance used to assign conversations: 'js' (Jensen-Shannon),
+                 'euclidean' or any other metric of codym_distances
+        batch_size - the number of conversations per iteration
+        n_iter - the maximum number of iterations
+        tol - the largest centroid move (Euclidean) at which to stop early
+        seed - seed for reproducible results
+        chunk_rows - the number of conversations labeled at a time in the final pass
+        n_jobs - number of threads computing distances
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        labels - cluster of each conversation
+        centroids - list of one CODYM per cluster, the average (as codym_avg)
+                    of its conversations, ready to pass to draw_codym
+    Example call:
+        labels, centroids = codym_kmeans(states_counts, trans_counts, 3, 4, seed=0)
+        draw_codym(centroids[0])
+    """
+
+    n = len(trans_counts)
+    if n < n_clusters:
+        raise ValueError('There must be at least as many conversations as clusters')
+    rng = np.random.default_rng(seed)
+
+    sample = np.sort(rng.choice(n, min(n, max(batch_size, 10*n_clusters)), replace=False))
+    centroids = _init_centroids(_rows(trans_counts, sample), n_clusters, metric, rng)
+    seen = np.zeros(n_clusters)
+    for _ in range(n_iter):
+        batch = _rows(trans_counts, np.sort(rng.choice(n, min(n, batch_size), replace=False)))
+        labels = np.argmin(codym_distances(batch, centroids, metric, n_jobs=n_jobs), axis=1)
+
+        # Move each centroid by its batch sum, with learning rate 1/(conversations seen)
+        n_batch = np.bincount(labels, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, batch)
+        seen += n_batch
+        has = n_batch > 0
+        step = (sums[has] - n_batch[has, None]*centroids[has]) / seen[has, None]
+        centroids[has] += step
+        if np.max(np.linalg.norm(step, axis=1), initial=0) < tol:
+            break
+
+    # Label every conversation and average each cluster, a chunk at a time
+    labels = np.zeros(n, dtype=np.int64)
+    sizes = np.zeros(n_clusters, dtype=np.int64)
+    sums = {'states_obs': np.zeros((n_clusters, np.shape(states_counts)[1])),
+            'trans_obs': np.zeros((n_clusters, np.shape(trans_counts)[1])),
+            'states_counts': np.zeros((n_clusters, np.shape(states_counts)[1]), dtype=np.int64),
+            'trans_counts': np.zeros((n_clusters, np.shape(trans_counts)[1]), dtype=np.int64)}
+    for start in range(0, n, chunk_rows):
+        rows = slice(start, start + chunk_rows)
+        s_counts = np.asarray(states_counts[rows], dtype=np.int64)
+        t_counts = np.asarray(trans_counts[rows], dtype=np.int64)
+        t_obs = codym_obs(t_counts)
+        l = np.argmin(codym_distances(t_obs, centroids, metric, n_jobs=n_jobs), axis=1)
+        labels[rows] = l
+        sizes += np.bincount(l, minlength=n_clusters)
+        for (name, values) in [('states_obs', codym_obs(s_counts)), ('trans_obs', t_obs),
+                               ('states_counts', s_counts), ('trans_counts', t_counts)]:
+            np.add.at(sums[name], l, values)
+
+    centroid_codyms = []
+    for c in range(n_clusters):
+        c_new = CODYM([], model_order, n_levels=n_levels)
+        c_new.states_obs = (sums['states_obs'][c] / max(sizes[c], 1)).tolist()
+        c_new.trans_obs = (sums['trans_obs'][c] / max(sizes[c], 1)).tolist()
+        c_new.states_counts = sums['states_counts'][c]
+        c_new.trans_counts = sums['trans_counts'][c]
+        c_new.n_convs = int(sizes[c])
+        centroid_codyms.append(c_new)
+    return(labels, centroid_codyms)
@@ -0,0 +1,248 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# On-disk corpus format for out-of-core CODYM analysis. A corpus is a directory:
+#
+#   corpus.json       - header (sizes, number of turn length bins, dtypes, mask
+#                       and metadata column names)
+#   turns.bin         - binned turn lengths of all conversations, uint8, or
+#                       bit-packed into big-endian 64-bit words (see CODYM_packed)
+#   offsets.bin       - n_convs+1 start offsets of each conversation into turns, int64
+#   mask_<name>.bin   - optional logical mask over turns, one byte per turn
+#   meta_<name>.bin   - optional per-conversation metadata column
+#
+# All arrays are raw binary files opened with np.memmap, so opening a corpus
+# takes no time regardless of its size.
+
+import json
+import os
+import numpy as np
+
+from CODYM import CODYM, codym_counts, codym_obs
+from CODYM_packed import PackedTurns, codym_counts_packed, n_words
+
+FORMAT_VERSION = 1
+
+class CorpusWriter():
+
+    def __init__(self, path, masks=(), meta=None, packed=False, n_levels=2):
+        """Write a corpus to disk one conversation at a time
+
+        Inputs:
+            path - directory to write the corpus to (created if needed)
+            masks - names of the logical masks stored with each conversation
+            meta - dict mapping per-conversation metadata names to numpy dtypes
+            packed - store turns bit-packed (1 bit per turn instead of 1 byte;
+                     binarized turns only)
+            n_levels - the number of turn length bins, as for CODYM (at most 256)
+        Example call:
+            with CorpusWriter('corpus', masks=['patient'], meta={'conv_num': 'uint32'}) as w:
+                w.add([0,1,1,0], masks={'patient': [1,0,1,0]}, meta={'conv_num': 7})
+        """
+
+        if packed and n_levels != 2:
+            raise ValueError('Only binarized turns (n_levels=2) can be packed')
+        if not 2 <= n_levels <= 256:
+            raise ValueError('Turns are stored one byte each, so n_levels must be between 2 and 256')
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.mask_names = list(masks)
+        self.meta_dtypes = {name: np.dtype(dtype).str for (name, dtype) in (meta or {}).items()}
+        self.packed = packed
+        self.n_levels = n_levels
+        self._bits = np.zeros(0, dtype=np.uint8) # Turns not yet packed into a full byte
+        self.offsets = [0]
+        self._files = {'turns': open(os.path.join(path, 'turns.bin'), 'wb')}
+        for name in self.mask_names:
+            self._files['mask_' + name] = open(os.path.join(path, 'mask_' + name + '.bin'), 'wb')
+        for name in self.meta_dtypes:
+            self._files['meta_' + name] = open(os.path.join(path, 'meta_' + name + '.bin'), 'wb')
+
+    def add(self, turn_lengths, masks=None, meta=None):
+        """Append one conversation (binned turn lengths, masks and metadata)"""
+
+        turns = np.asarray(turn_lengths)
+        if len(turns) and (turns.min() < 0 or turns.max() >= self.n_levels):
+            raise ValueError('Turn lengths must be binned into 0..' + str(self.n_levels-1))
+        turns = turns.astype(np.uint8)
+        if self.packed:
+            bits = np.concatenate((self._bits, turns))
+            n_full = len(bits) - len(bits) % 8
+            self._files['turns'].write(np.packbits(bits[:n_full]).tobytes())
+            self._bits = bits[n_full:]
+        else:
+            self._files['turns'].write(turns.tobytes())
+        for name in self.mask_names:
+            mask = np.asarray(masks[name], dtype=np.uint8)
+            if len(mask) != len(turns):
+                raise ValueError('Mask ' + name + ' does not match the number of turns')
+            self._files['mask_' + name].write(mask.tobytes())
+        for (name, dtype) in self.meta_dtypes.items():
+            self._files['meta_' + name].write(np.asarray([meta[name]], dtype=dtype).tobytes())
+        self.offsets.append(self.offsets[-1] + len(turns))
+
+    def close(self):
+        if self.packed:
+            # Pad the packed turns out to whole words plus the extra zero word
+            tail = np.packbits(self._bits).tobytes()
+            n_bytes = self.offsets[-1] // 8 + len(tail)
+            self._files['turns'].write(tail + bytes(8*n_words(self.offsets[-1]) - n_bytes))
+        for f in self._files.values():
+            f.close()
+        np.asarray(self.offsets, dtype=np.int64).tofile(os.path.join(self.path, 'offsets.bin'))
+        header = {'version': FORMAT_VERSION,
+                  'n_turns': self.offsets[-1],
+                  'n_convs': len(self.offsets) - 1,
+                  'packed': self.packed,
+                  'n_levels': self.n_levels,
+                  'masks': self.mask_names,
+                  'meta': self.meta_dtypes}
+        with open(os.path.join(self.path, 'corpus.json'), 'w') as f:
+            json.dump(header, f, indent=2)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def write_corpus(path, convs, masks=None, meta=None, packed=False, n_levels=2):
+    """Write a list of conversations to an on-disk corpus
+
+    Inputs:
+        path - directory to write the corpus to
+        convs - list of binarized turn length sequences, one per conversation
+        masks - optional dict mapping mask names to lists of per-conversation masks
+        meta - optional dict mapping metadata names to per-conversation values
+        packed - store turns bit-packed
+        n_levels - the number of turn length bins, as for CODYM
+    Example call:
+        write_corpus('corpus', turn_lens_all_convs, masks={'not_justice': not_justice})
+    """
+
+    masks = masks or {}
+    meta = {name: np.asarray(values) for (name, values) in (meta or {}).items()}
+    with CorpusWriter(path, masks, {name: values.dtype for (name, values) in meta.items()},
+                      packed, n_levels) as w:
+        for (i, conv) in enumerate(convs):
+            w.add(conv, {name: m[i] for (name, m) in masks.items()},
+                  {name: values[i] for (name, values) in meta.items()})
+
+class CODYMCorpus():
+
+    def __init__(self, path):
+        """Open an on-disk corpus written by CorpusWriter/write_corpus
+
+        Arrays are memory-mapped read-only: turns (a PackedTurns sequence for
+        packed corpora) and offsets, plus the dicts masks and meta of named 
+        columns.
+
+        Example call:
+            corpus = CODYMCorpus('corpus')
+            codym_norm = corpus.avg(3, mask='not_justice')
+        """
+
+        with open(os.path.join(path, 'corpus.json')) as f:
+            header = json.load(f)
+        if header['version'] > FORMAT_VERSION:
+            raise ValueError('Corpus format version ' + str(header['version']) + ' is not supported')
+
+        self.path = path
+        self.n_convs = header['n_convs']
+        self.packed = header.get('packed', False)
+        self.n_levels = header.get('n_levels', 2)
+        if self.packed:
+            self.turns = PackedTurns(self._memmap('turns.bin', '>u8', n_words(header['n_turns'])), 
+                                     header['n_turns'])
+        else:
+            self.turns = self._memmap('turns.bin', np.uint8, header['n_turns'])
+        self.offsets = self._memmap('offsets.bin', np.int64, self.n_convs+1)
+        self.masks = {name: self._memmap('mask_' + name + '.bin', np.bool_, header['n_turns'])
+                      for name in header['masks']}
+        self.meta = {name: self._memmap('meta_' + name + '.bin', dtype, self.n_convs)
+                     for (name, dtype) in header['meta'].items()}
+
+    def _memmap(self, filename, dtype, n):
+        # np.memmap cannot map empty files
+        if n == 0:
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(os.path.join(self.path, filename), dtype=dtype, mode='r', shape=(n,))
+
+    def __len__(self):
+        return self.n_convs
+
+    def conversation(self, i):
+        """Binned turn lengths of conversation i"""
+        if self.packed:
+            return self.turns.unpack(self.offsets[i], self.offsets[i+1])
+        return self.turns[self.offsets[i]:self.offsets[i+1]]
+
+    def codym(self, i, model_order, mask=None, **kwargs):
+        """Build the CODYM of conversation i, optionally using a named mask"""
+
+        kwargs.setdefault('n_levels', self.n_levels)
+        if mask is None:
+            return CODYM(self.conversation(i), model_order, **kwargs)
+        return CODYM(self.conversation(i), model_order,
+                     self.masks[mask][self.offsets[i]:self.offsets[i+1]], **kwargs)
+
+    def chunks(self, chunk_turns=2**24):
+        """Yield (i_start, i_end) ranges of conversations with about chunk_turns turns each"""
+
+        i_start = 0
+        while i_start < self.n_convs:
+            i_end = int(np.searchsorted(self.offsets, self.offsets[i_start] + chunk_turns, side='right')) - 1
+            i_end = min(max(i_end, i_start+1), self.n_convs)
+            yield i_start, i_end
+            i_start = i_end
+
+    def chunk_counts(self, model_order, mask=None, chunk_turns=2**24):
+        """Yield (i_start, i_end, states_counts, trans_counts) for each chunk of conversations
+
+        Only one chunk of the corpus is read into memory at a time.
+        """
+
+        for (i_start, i_end) in self.chunks(chunk_turns):
+            if self.packed:
+                states_counts, trans_counts = codym_counts_packed(
+                    self.turns, self.offsets[i_start:i_end+1], model_order,
+                    None if mask is None else self.masks[mask])
+                yield i_start, i_end, states_counts, trans_counts
+                continue
+            a, b = self.offsets[i_start], self.offsets[i_end]
+            states_counts, trans_counts = codym_counts(
+                self.turns[a:b], self.offsets[i_start:i_end+1] - a, model_order,
+                None if mask is None else self.masks[mask][a:b], self.n_levels)
+            yield i_start, i_end, states_counts, trans_counts
+
+    def counts(self, model_order, mask=None, chunk_turns=2**24):
+        """Per-conversation state and transition count matrices (as codym_counts)"""
+
+        states_counts = np.zeros((self.n_convs, self.n_levels**model_order), dtype=np.int64)
+        trans_counts = np.zeros((self.n_convs, self.n_levels**(model_order+1)), dtype=np.int64)
+        for (i_start, i_end, s, t) in self.chunk_counts(model_order, mask, chunk_turns):
+            states_counts[i_start:i_end] = s
+            trans_counts[i_start:i_end] = t
+        return states_counts, trans_counts
+
+    def avg(self, model_order, mask=None, chunk_turns=2**24):
+        """Average CODYM over all conversations (as codym_avg), computed chunk by chunk"""
+
+        c_new = CODYM([], model_order, n_levels=self.n_levels)
+        states_obs = np.zeros(self.n_levels**model_order)
+        trans_obs = np.zeros(self.n_levels**(model_order+1))
+        for (i_start, i_end, s, t) in self.chunk_counts(model_order, mask, chunk_turns):
+            states_obs += codym_obs(s).sum(axis=0)
+            trans_obs += codym_obs(t).sum(axis=0)
+            c_new.states_counts += s.sum(axis=0)
+            c_new.trans_counts += t.sum(axis=0)
+        c_new.states_obs = (states_obs / self.n_convs).tolist()
+        c_new.trans_obs = (trans_obs / self.n_convs).tolist()
+        c_new.n_convs = self.n_convs
+        return(c_new)
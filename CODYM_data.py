@@ -0,0 +1,275 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Cached loading of transcript datasets. The first load of a dataset parses it
+# and writes a columnar cache (one .npy file per column); later loads of the
+# same dataset read the cache instead.
+
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+CACHE_DIR = '.codym_cache'
+CACHE_FORMAT = 3 # Version of the cache layout; entries of other versions are rebuilt
+
+def _load_column(path):
+    """Load a cached column, memory-mapped copy-on-write (so it can be modified) if it holds no objects"""
+
+    try:
+        return np.load(path, mmap_mode='c')
+    except ValueError: # Object columns are pickled, and cannot be memory-mapped
+        return np.load(path, allow_pickle=True)
+
+def _read_columns(entry):
+    """Load a cached DataFrame, or None if there is no complete, current cache entry"""
+
+    if not os.path.exists(os.path.join(entry, 'columns.json')):
+        return None
+    with open(os.path.join(entry, 'columns.json')) as f:
+        meta = json.load(f)
+    if not isinstance(meta, dict) or meta.get('format') != CACHE_FORMAT:
+        return None
+    return pd.DataFrame({name: _load_column(os.path.join(entry, str(i) + '.npy'))
+                         for (i, name) in enumerate(meta['columns'])}, copy=False)
+
+def _write_columns(entry, data):
+    """Cache a DataFrame as one .npy file per column
+
+    Object columns (e.g. strings with missing values) are stored as pickled
+    object arrays, so they load back exactly, nulls included.
+    """
+
+    # Write to a temporary directory first, so an interrupted write is never read
+    os.makedirs(entry + '.tmp', exist_ok=True)
+    for (i, name) in enumerate(data.columns):
+        np.save(os.path.join(entry + '.tmp', str(i) + '.npy'), data[name].to_numpy())
+    with open(os.path.join(entry + '.tmp', 'columns.json'), 'w') as f:
+        json.dump({'format': CACHE_FORMAT, 'columns': [int(name) if isinstance(name, (int, np.integer)) else str(name)
+                                                   for name in data.columns]}, f)
+    shutil.rmtree(entry, ignore_errors=True) # A stale entry, of an older format
+    os.replace(entry + '.tmp', entry)
+
+def _file_hash(path, cache_dir):
+    """SHA-1 of a file's contents, remembered per (path, size, mtime) to skip rehashing"""
+
+    st = os.stat(path)
+    stamp = [os.path.abspath(path), st.st_size, st.st_mtime_ns]
+    index_path = os.path.join(cache_dir, 'hashes.json')
+    index = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+    key = json.dumps(stamp)
+    if key not in index:
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                h.update(block)
+        index[key] = h.hexdigest()
+        with open(index_path, 'w') as f:
+            json.dump(index, f)
+    return index[key]
+
+def _compact(col, flag=False):
+    """Convert a column to the smallest dtype holding its values
+
+    Integers become the smallest (unsigned if possible) integer type, and
+    flag columns (of only 0/1) become bool; floats and strings are left as
+    is. Other integer columns of only 0/1 (e.g. a speaker id) stay integers,
+    so a column's type does not depend on the values in it.
+    """
+
+    if pd.api.types.is_bool_dtype(col) or not pd.api.types.is_integer_dtype(col):
+        if flag and not pd.api.types.is_bool_dtype(col):
+            raise ValueError('Flag column ' + str(col.name) + ' must hold only 0/1')
+        return col
+    if flag:
+        if len(col) and (col.min() < 0 or col.max() > 1):
+            raise ValueError('Flag column ' + str(col.name) + ' must hold only 0/1')
+        return col.astype(bool)
+    return pd.to_numeric(col, downcast='unsigned' if not len(col) or col.min() >= 0 else 'integer')
+
+def load_csv(path, dtypes=None, flags=(), chunksize=10**6, cache_dir=None, **read_csv_kwargs):
+    """Load a CSV file of turns as a DataFrame, using a columnar cache
+
+    On the first load, the file is read in chunks and each column is stored
+    in its most compact dtype (e.g. uint32 conversation ids, uint16 word
+    counts, bool for the columns named in flags) unless given in dtypes.
+    Each chunk is compacted as it is parsed, so the whole table is never held
+    at pandas' default int64/object dtypes. The result is cached as one .npy
+    file per column, keyed by the file's content hash and the read options,
+    so later loads skip parsing altogether.
+
+    Inputs:
+        path - the CSV file
+        dtypes - optional dict of explicit column dtypes
+        flags - names of 0/1 columns to store as bool
+        chunksize - the number of rows parsed at a time
+        cache_dir - where to keep the cache (default: .codym_cache next to the file)
+        read_csv_kwargs - passed to pd.read_csv (e.g. header=1)
+    Example call:
+        data = load_csv('S1_dataset.csv', flags=['has_anger', 'has_fear'], header=1)
+    """
+
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+
+    options = json.dumps([dtypes, sorted(flags), read_csv_kwargs], sort_keys=True, default=str)
+    key = hashlib.sha1((_file_hash(path, cache_dir) + options).encode()).hexdigest()[:16]
+    entry = os.path.join(cache_dir, os.path.splitext(os.path.basename(path))[0] + '-' + key)
+
+    cached = _read_columns(entry)
+    if cached is not None:
+        return cached
+
+    def compact(data):
+        for name in data.columns:
+            if dtypes is None or name not in dtypes:
+                data[name] = _compact(data[name], name in flags)
+        return data
+
+    # Chunks are compacted as they are read; concat unifies their dtypes (e.g.
+    # uint8 and uint16 chunks to uint16), and a final pass compacts the result
+    chunks = pd.read_csv(path, dtype=dtypes, chunksize=chunksize, **read_csv_kwargs)
+    data = compact(pd.concat([compact(chunk) for chunk in chunks], ignore_index=True))
+
+    _write_columns(entry, data)
+    return(data)
+
+# Replace dashes (-), periods (.), apostrophes (') and slashes (/) with spaces,
+# and remove other punctuation (,?!";:)
+_PUNCTUATION = str.maketrans("-./'", '    ', ',?!";:')
+_SPACES = re.compile(' +')
+
+def word_count(text):
+    """Number of words in an utterance
+    
+    Same count as replacing [-./'] with spaces, removing [,?!";:], collapsing
+    repeated spaces and counting spaces + 1, in one translate and one regex pass.
+    """
+
+    return len(_SPACES.findall(text.translate(_PUNCTUATION))) + 1
+
+def _parse_utterances(task):
+    """Conversation id, speaker id and word count of each utterance in a byte range of utterances.jsonl"""
+
+    path, start, stop = task
+    conv_ids, speakers, n_words = [], [], []
+    with open(path, 'rb') as f:
+        f.seek(start)
+        if start:
+            f.readline() # The line containing start belongs to the previous range
+        while f.tell() <= stop:
+            line = f.readline()
+            if not line:
+                break
+            if not line.strip():
+                continue
+            utt = json.loads(line)
+            conv_ids.append(utt['conversation_id'] if 'conversation_id' in utt else utt['root'])
+            speakers.append(utt['speaker'] if 'speaker' in utt else utt['user'])
+            n_words.append(word_count(utt['text'] or ''))
+    return conv_ids, speakers, n_words
+
+def _speaker_meta(corpus_dir):
+    """Metadata of each speaker of a ConvoKit corpus directory"""
+
+    filename = 'speakers.json' if os.path.exists(os.path.join(corpus_dir, 'speakers.json')) else 'users.json'
+    with open(os.path.join(corpus_dir, filename)) as f:
+        speakers = json.load(f)
+    # Newer corpora store {'meta': ..., 'vectors': ...} per speaker
+    return {speaker: data['meta'] if isinstance(data, dict) and 'meta' in data and 'vectors' in data else data
+            for (speaker, data) in speakers.items()}
+
+def _corpus_version(corpus_dir):
+    with open(os.path.join(corpus_dir, 'index.json')) as f:
+        return json.load(f).get('version', 0)
+
+def load_convokit(name, speaker_attrs=(), corpus_dir=None, n_jobs=None, cache_dir=CACHE_DIR):
+    """Load per-utterance word counts and speaker attributes of a ConvoKit corpus
+
+    utterances.jsonl is parsed directly by a pool of worker processes, each
+    taking a byte range of the file, instead of loading a ConvoKit Corpus and
+    iterating over it in Python. The result is cached by corpus name and
+    version, so later loads skip ConvoKit (and the download) entirely.
+    ConvoKit is only needed to download a corpus that is not yet cached or
+    on disk.
+    As with any multiprocessing code, call this from under
+    if __name__ == '__main__': in scripts run on platforms that spawn
+    workers (Windows, macOS).
+
+    Inputs:
+        name - the ConvoKit corpus name, e.g. 'supreme-corpus'
+        speaker_attrs - speaker metadata fields to include, e.g. ['is-justice']
+        corpus_dir - directory of the downloaded corpus (default: ConvoKit's download directory)
+        n_jobs - number of worker processes (default: all cores)
+        cache_dir - where to keep the cache
+    Returns:
+        DataFrame with one row per utterance, in corpus order, with columns
+        conv_id, speaker, n_words and each of speaker_attrs
+    Example call:
+        data = load_convokit('supreme-corpus', ['is-justice'])
+    """
+
+    corpus_dir = corpus_dir or os.path.join(os.path.expanduser('~'), '.convokit', 'downloads', name)
+    os.makedirs(cache_dir, exist_ok=True)
+    attrs_key = hashlib.sha1(json.dumps(sorted(speaker_attrs)).encode()).hexdigest()[:8]
+    prefix = os.path.join(cache_dir, 'convokit-' + name + '-' + attrs_key + '-v')
+
+    # Without a local copy of the corpus, use the latest cached version
+    if os.path.exists(os.path.join(corpus_dir, 'index.json')):
+        version = _corpus_version(corpus_dir)
+    else:
+        versions = [int(entry[len(prefix):]) for entry in glob.glob(glob.escape(prefix) + '*')
+                    if entry[len(prefix):].isdigit()]
+        version = max(versions) if versions else None
+
+    if version is not None:
+        cached = _read_columns(prefix + str(version))
+        if cached is not None:
+            return cached
+
+    if not os.path.exists(os.path.join(corpus_dir, 'utterances.jsonl')):
+        from convokit import download
+        corpus_dir = download(name)
+        version = _corpus_version(corpus_dir)
+
+    # Split the utterances file into byte ranges, one or more per worker
+    path = os.path.join(corpus_dir, 'utterances.jsonl')
+    size = os.path.getsize(path)
+    n_jobs = n_jobs or os.cpu_count()
+    bounds = np.linspace(0, size, 4*n_jobs + 1).astype(int)
+    tasks = [(path, start, stop) for (start, stop) in zip(bounds[:-1], bounds[1:]) if stop > start]
+    if n_jobs == 1:
+        parsed = [_parse_utterances(task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(n_jobs) as ex:
+            parsed = list(ex.map(_parse_utterances, tasks))
+
+    data = pd.DataFrame({'conv_id': np.array([c for p in parsed for c in p[0]], dtype=str),
+                         'speaker': np.array([s for p in parsed for s in p[1]], dtype=str),
+                         'n_words': np.array([n for p in parsed for n in p[2]], dtype=np.uint32)})
+    if len(speaker_attrs):
+        meta = _speaker_meta(corpus_dir)
+        speakers, i_speaker = np.unique(data['speaker'].to_numpy(), return_inverse=True)
+        for attr in speaker_attrs:
+            values = [meta.get(speaker, {}).get(attr) for speaker in speakers]
+            # Flags missing for some speakers are False, so they stay bool rather than object
+            if all(v is None or isinstance(v, bool) for v in values):
+                values = [bool(v) for v in values]
+            data[attr] = pd.Series(values).to_numpy()[i_speaker]
+
+    _write_columns(prefix + str(version), data)
+    return(data)
@@ -0,0 +1,127 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Pairwise distances between the CODYMs of many conversations, given as rows of
+# a frequency matrix (e.g., codym_obs(trans_counts)).
+
+import numpy as np
+
+from CODYM_stats import _map
+
+METRICS = ('l1', 'euclidean', 'js', 'kl')
+
+def _block_l1(a, b, ctx):
+    return np.abs(a[:, None, :] - b[None, :, :]).sum(axis=2)
+
+def _block_euclidean(a, b, ctx):
+    # |a-b|^2 = |a|^2 + |b|^2 - 2 a.b, with the cross term as one matrix product
+    sq = ctx['sq_a'][:, None] + ctx['sq_b'][None, :] - 2 * a @ b.T
+    return np.sqrt(np.maximum(sq, 0))
+
+def _block_js(a, b, ctx):
+    # JS divergence = H(m) - (H(a) + H(b))/2, for the midpoint m of each pair
+    m = (a[:, None, :] + b[None, :, :]) / 2
+    h_m = -np.sum(m * np.log(np.where(m > 0, m, 1)), axis=2)
+    div = h_m - (ctx['h_a'][:, None] + ctx['h_b'][None, :]) / 2
+    return np.sqrt(np.maximum(div, 0))
+
+def _block_kl(a, b, ctx):
+    # KL(a||b) + KL(b||a) = sum (a-b)(log a - log b), expanded into matrix products
+    return (ctx['alog_a'][:, None] + ctx['alog_b'][None, :]
+            - a @ ctx['log_b'].T - ctx['log_a'] @ b.T)
+
+_BLOCKS = {'l1': _block_l1, 'euclidean': _block_euclidean, 'js': _block_js, 'kl': _block_kl}
+
+def _row_terms(x, metric, eps):
+    """Per-row terms each metric reuses across blocks"""
+
+    if metric == 'euclidean':
+        return {'sq': np.einsum('ij,ij->i', x, x)}
+    if metric == 'js':
+        return {'h': -np.sum(x * np.log(np.where(x > 0, x, 1)), axis=1)}
+    if metric == 'kl':
+        log_x = np.log(x + eps)
+        return {'log': log_x, 'alog': np.einsum('ij,ij->i', x, log_x)}
+    return {}
+
+def codym_distances(obs, obs_other=None, metric='js', block_size=None, n_jobs=None, out=None, eps=1e-12):
+    """Distances between every pair of CODYMs, computed in blocks
+
+    The distance matrix is filled block_size x block_size rows at a time, with
+    blocks computed in a thread pool. Euclidean and symmetric KL distances are
+    expanded into matrix products, so most of their work is done by BLAS. For
+    a single matrix, only blocks on or above the diagonal are computed and
+    the rest are mirrored.
+
+    Metrics:
+        'l1' - sum of absolute differences
+        'euclidean' - Euclidean distance
+        'js' - Jensen-Shannon distance (square root of the JS divergence, natural log)
+        'kl' - symmetric KL divergence, KL(p||q) + KL(q||p), with eps added to
+               frequencies before taking logs
+
+    Inputs:
+        obs - (n x n_features) frequency matrix, one row per conversation
+        obs_other - optional (m x n_features) matrix to compare against (default: obs)
+        metric - one of 'l1', 'euclidean', 'js', 'kl'
+        block_size - the number of rows per block (default: 1024 for 'euclidean' and
+                     'kl'; for 'l1' and 'js', which broadcast over every pair of a
+                     block, small enough to keep that array near 32 MB)
+        n_jobs - number of threads (default: all cores)
+        out - optional output: an (n x m) array (e.g. a memmap), or a path to
+              create a .npy file at, memory-mapped so N can exceed memory
+        eps - smoothing of the KL divergence
+    Returns:
+        (n x m) distance matrix
+    Example call:
+        D = codym_distances(codym_obs(trans_counts), metric='js', out='distances.npy')
+    """
+
+    if metric not in METRICS:
+        raise ValueError('metric must be one of ' + ', '.join(METRICS))
+    symmetric = obs_other is None
+    a_all = np.asarray(obs, dtype=float)
+    b_all = a_all if symmetric else np.asarray(obs_other, dtype=float)
+    if a_all.shape[1] != b_all.shape[1]:
+        raise ValueError('Both matrices must have the same number of columns')
+
+    shape = (len(a_all), len(b_all))
+    if out is None:
+        out = np.zeros(shape)
+    elif isinstance(out, str):
+        out = np.lib.format.open_memmap(out, mode='w+', dtype=float, shape=shape)
+    elif out.shape != shape:
+        raise ValueError('out must have shape ' + str(shape))
+
+    if block_size is None:
+        block_size = 1024 if metric in ('euclidean', 'kl') else max(int(np.sqrt(2**22 / max(a_all.shape[1], 1))), 1)
+
+    terms_a = _row_terms(a_all, metric, eps)
+    terms_b = terms_a if symmetric else _row_terms(b_all, metric, eps)
+    block = _BLOCKS[metric]
+    starts_a = range(0, shape[0], block_size)
+    starts_b = range(0, shape[1], block_size)
+    tasks = [(i, j) for i in starts_a for j in starts_b if not symmetric or j >= i]
+
+    def run(task):
+        i, j = task
+        rows, cols = slice(i, i+block_size), slice(j, j+block_size)
+        ctx = {name + '_a': v[rows] for (name, v) in terms_a.items()}
+        ctx.update({name + '_b': v[cols] for (name, v) in terms_b.items()})
+        d = block(a_all[rows], b_all[cols], ctx)
+        if symmetric and i == j:
+            np.fill_diagonal(d, 0)
+        out[rows, cols] = d
+        if symmetric and j > i:
+            out[cols, rows] = d.T
+
+    _map(run, tasks, n_jobs)
+    if isinstance(out, np.memmap):
+        out.flush()
+    return(out)
@@ -8,69 +8,37 @@
 # and the source website is properly cited
 
 import numpy as np
-import re
 
-from CODYM import CODYM
-from CODYM import codym_avg
+from CODYM_data import load_convokit
+from CODYM_binarize import QuantileSketch
+from CODYM_frame import frame_counts
+from CODYM import codym_avg_counts
 from draw_CODYM import draw_codym
 
-from convokit import Corpus, download
+# load_convokit parses the corpus in worker processes, so the script must be
+# importable without side effects on platforms that spawn workers (Windows, macOS)
+if __name__ == '__main__':
+    # Load word counts and speaker attributes of the supreme court corpus from ConvoKit
+    # (cached after the first run)
+    data = load_convokit('supreme-corpus', ['is-justice'])
 
-# Load the supreme court corpus from ConvoKit
-if 'corpus' not in locals():
-    corpus = Corpus(filename=download("supreme-corpus"))
-    
-conv_ids = [] # ID of each conversation
-convs = [] # Number of words in each speaker utterance, for each conversation
-speakers = [] # Speaker of each utterance, for each conversation
+    # Alternatively, use gender to define a speaker:
+    # data = load_convokit('supreme-corpus', ['sex']) and mask with data['sex'] == 'FEMALE'
 
-for conv in corpus.iter_conversations():
-
-    turn = [] # All words in the utterance
-    speaker = [] # Speaker of each turn, for each conversation
-    n_words = [] # Number of words per turn, for each conversation
-
-    for utt in conv.iter_utterances():
-        turn = utt.text
-        
-        # Replace dashes (-), periods (.), apostrophes (') and slashes (/) with spaces
-        turn = re.sub("[-./']",' ',turn) 
-        
-        # Remove other punctuation (,?!";:)
-        turn = re.sub('[,?!";:]','',turn) # remove punctuation
-        
-        # Replace double spaces w/ single ones
-        turn = re.sub('[ ]{2,}',' ',turn) 
-        
-        n_words.append(turn.count(' ')+1)
-        
-        # Alternatively, use gender to define a speaker:
-        # speaker.append(1 if utt.speaker.meta['sex'] == 'FEMALE' else 0)
-        
-        # Speaker 1 indicates a supreme court justice, 0 indicates not a justice
-        if utt.speaker.meta['is-justice']:
-            speaker.append(1)
-        else:
-            speaker.append(0)
-            
     # Only include cases with 20 or more turns.
-    if len(n_words) >= 20:
-        conv_ids.append(conv.get_id())
-        convs.append(n_words)
-        speakers.append(speaker)
+    n_turns = data.groupby('conv_id', sort=False)['n_words'].transform('size')
+    data = data[(n_turns >= 20).to_numpy()]
 
-# Binarize turn lengths
-t = np.round(np.median(np.hstack(convs))) # The short/long threshold
-turn_lens_all_convs = [[int(l >= t) for l in conv] for conv in convs]
+    # Binarize turn lengths, at the median length (from a sketch of the lengths; exact
+    # mode counts each distinct length, which is compact for word counts)
+    t = np.round(QuantileSketch(exact=True).add(data['n_words']).quantile(0.5)) # The short/long threshold
 
-# Define a CODYM model for each conversation
-CODYMS = []
-for i in range(len(convs)):
-    turn_lengths = turn_lens_all_convs[i]
-    speaker = speakers[i]
-    speaker = [1 if not i else 0 for i in speaker]
-    CODYMS.append(CODYM(turn_lengths,3,speaker))
+    # Define a CODYM model for each conversation, as rows of state/transition counts,
+    # including only turns by speakers who are not supreme court justices
+    not_justice = ~data['is-justice'].to_numpy(dtype=bool)
+    conv_ids, states_counts, trans_counts, order, offsets = frame_counts(
+        data, 'conv_id', 'n_words', t, not_justice, 3)
 
-codym_norm = codym_avg(CODYMS)
+    codym_norm = codym_avg_counts(states_counts, trans_counts, 3)
 
-draw_codym(codym_norm) # Draw the normative CODYM
+    draw_codym(codym_norm) # Draw the normative CODYM
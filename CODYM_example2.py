@@ -7,31 +7,18 @@
 # provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
 # and the source website is properly cited
 
-import numpy as np
-import pandas as pd
-
-from CODYM import CODYM
-from CODYM import codym_avg
+from CODYM_data import load_csv
+from CODYM_frame import build_codyms
 from draw_CODYM import draw_codym
 
-data = pd.read_csv('S1_dataset.csv', header=1)
-
-# For each conversation
-CODYMS_with_emo = []
-CODYMS_without_emo = []
+data = load_csv('S1_dataset.csv', flags=['has_anger', 'has_fear'], header=1) # Cached after the first run
 
-for conv_num in np.unique(data['conv_num']):
-    
-    conv_mask = data['conv_num'] == conv_num
-    emo_mask = list(np.any(data[conv_mask][['has_anger','has_fear']].values,axis=1).astype(int))
-    speaker_mask = list(data[conv_mask]['speaker']==0) # patient turns only
-    tur_lens = list((data[conv_mask]['n_words'] >= 8).values.astype(int))
-    
-    if any(emo_mask):
-        CODYMS_with_emo.append(CODYM(tur_lens, 3, speaker_mask))
-    else:
-        CODYMS_without_emo.append(CODYM(tur_lens, 3, speaker_mask))        
+# Average CODYMs of patient turns, for conversations with and without 
+# expressed emotion (anger or fear in any turn)
+has_emo = data[['has_anger','has_fear']].any(axis=1)
+CODYMS = build_codyms(data, by='conv_num', length='n_words', threshold=8,
+                      mask='speaker==0', split_by=has_emo, model_order=3)
         
-CODYM_emo = codym_avg(CODYMS_with_emo) - codym_avg(CODYMS_without_emo)
+CODYM_emo = CODYMS[True] - CODYMS[False]
 
 draw_codym(CODYM_emo, True) # Draw the normative difference CODYM
@@ -0,0 +1,86 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+import numpy as np
+
+from CODYM import codym_counts, codym_avg_counts
+
+def _column(df, col):
+    """Values of a column name, an expression on the columns (e.g. 'speaker==0'), or an array"""
+
+    if isinstance(col, str):
+        values = df[col] if col in df.columns else df.eval(col)
+    else:
+        values = col
+    return np.asarray(values)
+
+def frame_counts(df, by='conv_num', length='n_words', threshold=8, mask=None, model_order=3):
+    """Count the states and transitions of every conversation in a table of turns
+
+    The table is sorted by conversation once (stably, so turns keep their
+    order within each conversation) and all conversations are counted in one
+    pass with codym_counts, instead of masking the whole table per conversation.
+
+    Inputs:
+        df - DataFrame with one row per turn
+        by - column identifying the conversation of each turn
+        length - column of turn lengths
+        threshold - turns of at least this length are long (1), others short (0); or
+                    a sorted list of thresholds binning lengths into len(threshold)+1
+                    levels (e.g. [5, 20] for short/medium/long)
+        mask - optional column name, expression or array selecting the turns to include
+        model_order - the order of the CODYM models
+    Returns:
+        conv_ids - the (sorted) conversation ids
+        states_counts, trans_counts - count matrices, one row per conversation
+        order, offsets - the sorting of the rows and start of each conversation,
+                         for aligning other per-row columns
+    Example call:
+        conv_ids, states_counts, trans_counts, order, offsets = frame_counts(data, mask='speaker==0')
+    """
+
+    conv = np.asarray(df[by])
+    order = np.argsort(conv, kind='stable')
+    conv_ids, starts = np.unique(conv[order], return_index=True)
+    offsets = np.append(starts, len(conv))
+
+    thresholds = np.atleast_1d(threshold)
+    turns = np.digitize(np.asarray(df[length])[order], thresholds).astype(np.uint8)
+    if mask is not None:
+        mask = _column(df, mask).astype(bool)[order]
+    states_counts, trans_counts = codym_counts(turns, offsets, model_order, mask, len(thresholds)+1)
+    return(conv_ids, states_counts, trans_counts, order, offsets)
+
+def build_codyms(df, by='conv_num', length='n_words', threshold=8, mask=None, split_by=None,
+                 model_order=3):
+    """Build the average CODYM of each group of conversations in a table of turns
+
+    Inputs:
+        df, by, length, threshold, mask, model_order - as for frame_counts
+        split_by - optional column name, expression or array; each conversation
+                   is grouped by its largest value over its turns (so a logical
+                   column marks conversations where it occurs in any turn)
+    Returns:
+        the average CODYM (as codym_avg) of all conversations, or a dict mapping
+        each group to its average CODYM if split_by is given
+    Example call:
+        models = build_codyms(data, 'conv_num', 'n_words', 8, mask='speaker==0',
+                              split_by=data[['has_anger','has_fear']].any(axis=1))
+        CODYM_emo = models[True] - models[False]
+    """
+
+    conv_ids, states_counts, trans_counts, order, offsets = frame_counts(
+        df, by, length, threshold, mask, model_order)
+    n_levels = len(np.atleast_1d(threshold)) + 1
+    if split_by is None:
+        return codym_avg_counts(states_counts, trans_counts, model_order, n_levels)
+
+    groups = np.maximum.reduceat(_column(df, split_by)[order], offsets[:-1]) if len(conv_ids) else []
+    return({g: codym_avg_counts(states_counts[groups == g], trans_counts[groups == g], model_order, n_levels)
+            for g in np.unique(groups)})
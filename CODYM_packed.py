@@ -0,0 +1,128 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+import numpy as np
+
+from CODYM import _count_windows
+
+# Windows are read from a pair of adjacent 64-bit words
+MAX_WINDOW = 64
+
+class PackedTurns():
+
+    def __init__(self, words, n_turns):
+        """A sequence of binarized turn lengths packed 64 to a word
+
+        Turn i is bit 63-(i%64) of word i//64, i.e. the same layout as
+        np.packbits read as big-endian 64-bit words. The words are followed by
+        one extra (zero) word, so any window can be read from two adjacent
+        words. This is 64x smaller than an int64 array of the turns.
+
+        Inputs:
+            words - big-endian uint64 array of packed turns (e.g., a memmap)
+            n_turns - the number of turns in the sequence
+        Example call:
+            PackedTurns.pack(np.random.randint(0,2,1000))
+        """
+
+        self.words = words
+        self.n_turns = n_turns
+
+    @classmethod
+    def pack(cls, turn_lengths):
+        """Pack a sequence of binarized turn lengths"""
+
+        return cls(np.frombuffer(pack_bytes(turn_lengths), dtype='>u8'), len(turn_lengths))
+
+    def __len__(self):
+        return self.n_turns
+
+    def unpack(self, start=0, stop=None):
+        """Binarized turn lengths start:stop, as a uint8 array"""
+
+        stop = self.n_turns if stop is None else min(stop, self.n_turns)
+        if stop <= start:
+            return np.zeros(0, dtype=np.uint8)
+        first, last = start // 64, (stop - 1) // 64 + 1
+        bits = np.unpackbits(np.asarray(self.words[first:last], dtype='>u8').view(np.uint8))
+        return bits[start-64*first:stop-64*first]
+
+    def window_codes(self, n_bits, start, stop):
+        """Integer codes of the n_bits-turn windows starting at turns start:stop
+
+        Codes are read directly from the packed words, first turn in the most
+        significant bit (as CODYM._window_codes). The 64 windows starting in
+        a word all come from that word and the next, so they are coded with
+        the same 64 shifts of every word pair, without indexing turn by turn.
+        """
+
+        if n_bits > MAX_WINDOW - 1:
+            raise ValueError('Windows of packed turns are limited to ' + str(MAX_WINDOW-1) + ' turns')
+        if stop <= start:
+            return np.zeros(0, dtype=np.int64)
+        first, last = start >> 6, ((stop - 1) >> 6) + 1
+        words = np.asarray(self.words[first:last+1], dtype=np.uint64) # Ends on the extra zero word at most
+        shift = np.arange(64, dtype=np.uint64)
+
+        # Row w, column j: the 64 bits from bit j of word w (lo is shifted in
+        # two steps, as a 64-bit shift is undefined)
+        windows = words[:-1, None] << shift
+        windows |= (words[1:, None] >> np.uint64(1)) >> (np.uint64(63) - shift)
+        windows >>= np.uint64(64 - n_bits)
+        return windows.ravel()[start-64*first:stop-64*first].astype(np.int64)
+
+def n_words(n_turns):
+    """Number of words holding n_turns packed turns, including the extra zero word"""
+    return -(-n_turns // 64) + 1
+
+def pack_bytes(turn_lengths):
+    """Pack binarized turn lengths into bytes, padded with the extra zero word"""
+
+    packed = np.packbits(np.asarray(turn_lengths, dtype=np.uint8))
+    return packed.tobytes() + bytes(8*n_words(len(turn_lengths)) - len(packed))
+
+def codym_counts_packed(packed, offsets, model_order, mask=None, chunk_turns=2**22):
+    """Count the states and transitions of every conversation in packed turns
+
+    Same results as CODYM.codym_counts, with windows coded straight from the
+    packed words, chunk_turns windows at a time. offsets index into the packed
+    turns and need not start at 0, so a slice of the offsets of a larger corpus
+    counts just those conversations.
+
+    Inputs:
+        packed - a PackedTurns sequence of all conversations
+        offsets - array of n_conversations+1 start offsets into the packed turns
+        model_order - the order of the CODYM model (at most 62)
+        mask - optional logical mask over all of the packed turns
+        chunk_turns - the number of windows coded at a time
+    Returns:
+        states_counts - (n_conversations x 2^model_order) array of state counts
+        trans_counts - (n_conversations x 2^(model_order+1)) array of transition counts
+    """
+
+    offsets = np.asarray(offsets, dtype=np.int64)
+    n_convs = len(offsets) - 1
+    states_counts = np.zeros((n_convs, 2**model_order), dtype=np.int64)
+    trans_counts = np.zeros((n_convs, 2**(model_order+1)), dtype=np.int64)
+
+    # Windows can start anywhere a state could; the final one has no transition
+    first, last = offsets[0], offsets[-1] - model_order
+    for start in range(first, last, chunk_turns):
+        stop = min(start + chunk_turns, last)
+
+        # Each (model_order+1)-turn window holds a state and its transition
+        codes = packed.window_codes(model_order+1, start, stop)
+        states = codes >> 1
+        transitions = ((codes & 1) << model_order) | states
+        transitions = transitions[:max(min(stop, last-1) - start, 0)]
+
+        i_conv, s, t = _count_windows(states, transitions, start, offsets, model_order, mask)
+        states_counts[i_conv:i_conv+len(s)] += s
+        trans_counts[i_conv:i_conv+len(t)] += t
+    return(states_counts, trans_counts)
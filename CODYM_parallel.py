@@ -0,0 +1,119 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+import numpy as np
+from multiprocessing import Pool, cpu_count, shared_memory
+
+from CODYM import codym_counts
+
+# Arrays attached to shared memory in each worker process
+_shared = {}
+
+def _to_shared(a, blocks):
+    """Copy an array into a new shared memory block, returning its description"""
+
+    shm = shared_memory.SharedMemory(create=True, size=max(a.nbytes, 1))
+    blocks.append(shm)
+    np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)[:] = a
+    return (shm.name, a.shape, a.dtype.str)
+
+def _attach(desc):
+    shm = shared_memory.SharedMemory(name=desc[0])
+    return shm, np.ndarray(desc[1], dtype=np.dtype(desc[2]), buffer=shm.buf)
+
+def _init_worker(descs):
+    for name, desc in descs.items():
+        if desc is None:
+            _shared[name] = None
+        else:
+            # Keep a reference to the block so the buffer stays mapped
+            _shared[name + '_shm'], _shared[name] = _attach(desc)
+
+def _count_chunk(task):
+    """Count the conversations i_start:i_end, as rows of the full corpus"""
+
+    i_start, i_end, model_order, merge, n_levels = task
+    offsets = _shared['offsets'][i_start:i_end+1]
+    a, b = offsets[0], offsets[-1]
+    mask = None if _shared['mask'] is None else _shared['mask'][a:b]
+    states_counts, trans_counts = codym_counts(_shared['turns'][a:b], offsets - a, model_order, mask, n_levels)
+
+    if merge:
+        return states_counts.sum(axis=0), trans_counts.sum(axis=0)
+    _shared['states_counts'][i_start:i_end] = states_counts
+    _shared['trans_counts'][i_start:i_end] = trans_counts
+
+def codym_counts_parallel(turn_lengths, offsets, model_order, mask=None, merge=False,
+                          n_jobs=None, n_chunks=None, n_levels=2):
+    """Count the states and transitions of every conversation using a process pool
+
+    Same inputs and results as CODYM.codym_counts, but conversations are split
+    into chunks of roughly equal numbers of turns and counted by separate
+    worker processes. The turn, offset and mask arrays are placed in shared
+    memory once rather than pickled for each task, and per-conversation
+    counts are written straight into a shared output matrix. As with any
+    multiprocessing code, call this from under if __name__ == '__main__': in
+    scripts run on platforms that spawn workers (Windows, macOS).
+
+    Inputs:
+        turn_lengths - flat array of binarized turn lengths for all conversations
+        offsets - array of n_conversations+1 start offsets into turn_lengths
+        model_order - the order of the CODYM model
+        mask - optional flat logical mask of turns to be included, matching turn_lengths
+        merge - return the counts summed over all conversations instead of per conversation
+        n_jobs - number of worker processes (default: all cores)
+        n_chunks - number of chunks of conversations (default: 4 per worker)
+        n_levels - the number of turn length bins, as for CODYM
+    Returns:
+        states_counts, trans_counts - as codym_counts, or summed over rows if merge
+    Example call:
+        codym_counts_parallel(np.random.randint(0,2,10**6), np.arange(0,10**6+1,100), 3)
+    """
+
+    n_jobs = n_jobs or cpu_count()
+    turns = np.ascontiguousarray(turn_lengths, dtype=np.uint8)
+    offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+    if mask is not None:
+        mask = np.ascontiguousarray(mask, dtype=bool)
+    n_convs = len(offsets) - 1
+
+    if n_jobs == 1 or n_convs == 0:
+        states_counts, trans_counts = codym_counts(turns, offsets, model_order, mask, n_levels)
+        if merge:
+            return states_counts.sum(axis=0), trans_counts.sum(axis=0)
+        return states_counts, trans_counts
+
+    # Chunk boundaries (in conversations) splitting the turns evenly
+    n_chunks = min(n_chunks or 4*n_jobs, max(n_convs, 1))
+    bounds = np.searchsorted(offsets, np.linspace(0, offsets[-1], n_chunks+1), side='left')
+    bounds[0], bounds[-1] = 0, n_convs
+    bounds = np.unique(bounds)
+    tasks = [(i, j, model_order, merge, n_levels) for (i, j) in zip(bounds[:-1], bounds[1:])]
+
+    blocks = []
+    try:
+        descs = {'turns': _to_shared(turns, blocks),
+                 'offsets': _to_shared(offsets, blocks),
+                 'mask': None if mask is None else _to_shared(mask, blocks)}
+        if not merge:
+            descs['states_counts'] = _to_shared(np.zeros((n_convs, n_levels**model_order), dtype=np.int64), blocks)
+            descs['trans_counts'] = _to_shared(np.zeros((n_convs, n_levels**(model_order+1)), dtype=np.int64), blocks)
+
+        with Pool(n_jobs, initializer=_init_worker, initargs=(descs,)) as pool:
+            results = pool.map(_count_chunk, tasks)
+
+        if merge:
+            return (np.sum([r[0] for r in results], axis=0),
+                    np.sum([r[1] for r in results], axis=0))
+        return (np.ndarray(descs['states_counts'][1], dtype=np.int64, buffer=blocks[-2].buf).copy(),
+                np.ndarray(descs['trans_counts'][1], dtype=np.int64, buffer=blocks[-1].buf).copy())
+    finally:
+        for shm in blocks:
+            shm.close()
+            shm.unlink()
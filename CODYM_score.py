@@ -0,0 +1,124 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Scoring of conversations against a reference (e.g., normative) CODYM: how
+# surprising each turn is given the model_order turns before it.
+
+import numpy as np
+
+from CODYM import codym_conditional, _window_codes, _check_levels
+
+class CODYMScorer():
+
+    def __init__(self, codym, smoothing=1e-3):
+        """Log-probability lookup table of a reference CODYM, for scoring turns
+
+        The table is indexed by the integer code of a window of model_order+1
+        turns (oldest first, as CODYM codes states), and holds log2 P(last turn
+        of the window | the turns before it). A turn is then scored with a
+        single lookup, for a whole corpus at once or one turn at a time.
+        Transitions the reference never makes would be infinitely surprising,
+        so smoothing is added to every conditional probability before
+        renormalizing; states the reference never leaves are uniform.
+
+        Inputs:
+            codym - the reference CODYM (not a difference CODYM)
+            smoothing - probability added to every next turn length of each state
+        Example call:
+            scorer = CODYMScorer(codym_norm)
+            surprise, loglik = scorer.score(turn_lengths, offsets)
+        """
+
+        self.model_order = codym.model_order
+        self.n_levels = codym.n_levels
+        self.smoothing = smoothing
+        cond = codym_conditional(codym._dense_trans(), self.model_order, self.n_levels)
+        cond = (cond + smoothing) / (1 + self.n_levels*smoothing)
+        # Row s, column x is window code s*n_levels + x (-inf without smoothing
+        # for transitions never made)
+        with np.errstate(divide='ignore'):
+            self.log_prob = np.log2(cond).ravel()
+
+    def score(self, turn_lengths, offsets=None, mask=None):
+        """Per-turn surprise and cumulative log-likelihood of one or many conversations
+
+        Inputs:
+            turn_lengths - binarized turn lengths (of all conversations, flattened)
+            offsets - optional array of n_conversations+1 start offsets into turn_lengths
+            mask - optional logical mask of the turns to score
+        Returns:
+            surprise - -log2 P(turn | previous model_order turns) of each turn; NaN for
+                       the first model_order turns of each conversation and masked turns
+            loglik - log2-likelihood of each conversation's scored turns up to and
+                     including each turn (its value at a conversation's last turn
+                     is the conversation's log-likelihood)
+        """
+
+        turns = np.asarray(turn_lengths, dtype=np.int64)
+        _check_levels(turns, self.n_levels)
+        k = self.model_order
+        n_turns = len(turns)
+        offsets = np.array([0, n_turns]) if offsets is None else np.asarray(offsets, dtype=np.int64)
+
+        # Window ending on each turn from turn k onwards, looked up in one step
+        log_prob = np.full(n_turns, np.nan)
+        log_prob[k:] = self.log_prob[_window_codes(turns, k+1, max(n_turns-k, 0), self.n_levels)]
+
+        # Windows reaching back into the previous conversation are not scored
+        conv = np.repeat(np.arange(len(offsets)-1), np.diff(offsets))
+        log_prob[np.arange(n_turns) - offsets[conv] < k] = np.nan
+        if mask is not None:
+            log_prob[~np.asarray(mask, dtype=bool)] = np.nan
+
+        # Cumulative sums restarted at each conversation
+        total = np.cumsum(np.where(np.isnan(log_prob), 0, log_prob))
+        before = np.concatenate(([0], total))[offsets[:-1]]
+        return(-log_prob, total - before[conv])
+
+    def stream(self):
+        """A ScoreStream scoring one live conversation against this reference"""
+        return ScoreStream(self)
+
+class ScoreStream():
+
+    def __init__(self, scorer):
+        """Score the turns of a conversation as they arrive, in constant time per turn
+
+        Only the code of the last model_order turns is kept. Create with
+        CODYMScorer.stream().
+
+        Example call:
+            stream = scorer.stream()
+            for turn_length in [0,1,1,0,1]:
+                surprise, loglik = stream.push(turn_length)
+        """
+
+        self.scorer = scorer
+        self.n_turns = 0
+        self.loglik = 0.0
+        self._state = 0 # Code of the last model_order turns
+
+    def push(self, turn_length, include=True):
+        """Score the next binarized turn length (include is its mask value)
+
+        Returns the turn's surprise (NaN before model_order turns have been
+        seen, or if not included) and the log-likelihood so far.
+        """
+
+        b = self.scorer.n_levels
+        k = self.scorer.model_order
+        if not 0 <= int(turn_length) < b:
+            raise ValueError('Turn lengths must be binned into 0..' + str(b-1))
+        surprise = np.nan
+        if self.n_turns >= k and include:
+            surprise = -self.scorer.log_prob[self._state*b + int(turn_length)]
+            self.loglik -= surprise
+        self._state = (self._state*b + int(turn_length)) % b**k
+        self.n_turns += 1
+        return(surprise, self.loglik)
@@ -0,0 +1,84 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+# Synthetic conversations following the transition structure of a CODYM, for
+# null models and benchmarks.
+
+import numpy as np
+
+from CODYM import codym_conditional, codym_stationary, _decode
+
+def conversation_lengths(n_convs, lengths, rng):
+    """Number of turns of each synthetic conversation
+
+    lengths is a single length, an array with one length per conversation, or
+    a function drawing n_convs lengths from a random generator, e.g.
+    lambda rng, n: rng.poisson(100, n).
+    """
+
+    if callable(lengths):
+        lengths = lengths(rng, n_convs)
+    lengths = np.broadcast_to(np.asarray(lengths, dtype=np.int64), (n_convs,))
+    if np.any(lengths < 0):
+        raise ValueError('Conversation lengths must be non-negative')
+    return lengths
+
+def codym_simulate(codym, n_convs, lengths=100, seed=None, initial=None):
+    """Generate turn sequences from the transition structure of a CODYM
+
+    The transitions give P(next turn length | last model_order turns). Each
+    conversation starts from a state drawn from initial, and all
+    conversations are stepped together: one vectorized draw per turn index,
+    over the conversations that are still that long. Conversations are
+    processed longest first, so these are always a prefix.
+
+    Inputs:
+        codym - the CODYM to simulate (not a difference CODYM)
+        n_convs - the number of conversations
+        lengths - conversation lengths, as for conversation_lengths
+        seed - seed for reproducible results
+        initial - optional probabilities of the starting state (its first
+                  model_order turns); default: the stationary distribution
+    Returns:
+        turn_lengths - flat uint8 array of the turns of all conversations
+        offsets - array of n_convs+1 start offsets into turn_lengths, as for codym_counts
+    Example call:
+        turn_lengths, offsets = codym_simulate(codym_norm, 10**6, lambda rng, n: rng.poisson(80, n), seed=0)
+        states_counts, trans_counts = codym_counts(turn_lengths, offsets, 3)
+    """
+
+    rng = np.random.default_rng(seed)
+    k, b = codym.model_order, codym.n_levels
+    n_states = b**k
+    trans = codym._dense_trans()
+    cdf = np.cumsum(codym_conditional(trans, k, b), axis=1)
+    cdf[:, -1] = 1 # Guard against round-off
+
+    lengths = conversation_lengths(n_convs, lengths, rng)
+    offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+    turns = np.zeros(offsets[-1], dtype=np.uint8)
+
+    # Starting states, written out as the first model_order turns (or fewer)
+    p = codym_stationary(trans, k, b) if initial is None else np.asarray(initial, dtype=float)
+    states = rng.choice(n_states, size=n_convs, p=p / p.sum())
+    digits = _decode(states, k, b)
+    for j in range(k):
+        has = lengths > j
+        turns[offsets[:-1][has] + j] = digits[has, j]
+
+    order = np.argsort(-lengths, kind='stable')
+    starts = offsets[:-1][order]
+    states = states[order]
+    n_active = np.searchsorted(-lengths[order], -np.arange(k, lengths.max(initial=0)), side='left')
+    for (t, n) in zip(range(k, lengths.max(initial=0)), n_active):
+        # n conversations have more than t turns; draw their turn t
+        x = (rng.random(n)[:, None] > cdf[states[:n]]).sum(axis=1)
+        turns[starts[:n] + t] = x
+        states[:n] = (states[:n]*b + x) % n_states
+    return(turns, offsets)
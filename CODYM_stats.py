@@ -0,0 +1,186 @@
+# Author: Dr. Laurence A. Clarfeld
+# Copyright: 4/22/2021
+#
+# All Rights Reserved. Permission to use, copy, modify, and distribute this software
+# for educational, research, and not-for-profit purposes,
+# without fee and without a signed licensing agreement, is hereby granted,
+# provided that the Author (Dr. Laurence A. Clarfeld) is properly credited
+# and the source website is properly cited
+
+import os
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+from CODYM import codym_obs
+
+BATCH_CELLS = 2**22 # Most (resamples x conversations) entries per batch array
+
+def _batches(n, batch_size, n_rows=1):
+    """Sizes of the batches splitting n draws, each a (size x n_rows) array of at most BATCH_CELLS entries"""
+    batch_size = max(1, min(batch_size, BATCH_CELLS // max(n_rows, 1)))
+    return [min(batch_size, n - i) for i in range(0, n, batch_size)]
+
+def _map(fun, args, n_jobs):
+    """Map over args in a thread pool (the work is BLAS/numpy, which releases the GIL)"""
+
+    n_jobs = n_jobs or os.cpu_count()
+    if n_jobs == 1:
+        return [fun(a) for a in args]
+    with ThreadPoolExecutor(n_jobs) as ex:
+        return list(ex.map(fun, args))
+
+def bootstrap_means(obs, n_boot=10000, seed=None, n_jobs=None, batch_size=500):
+    """Column means of bootstrap resamples of the rows of obs
+
+    Each resample draws len(obs) rows (conversations) with replacement. A
+    batch of resamples is drawn as one matrix of row indices, turned into
+    per-row multiplicities, and averaged with a single matrix product. Each
+    batch has its own random stream spawned from seed, so results do not
+    depend on n_jobs.
+
+    Inputs:
+        obs - (n_conversations x n_features) array, e.g. from codym_obs
+        n_boot - the number of bootstrap resamples
+        seed - seed (or np.random.SeedSequence) for reproducible results
+        n_jobs - number of threads (default: all cores)
+        batch_size - the number of resamples drawn at a time (fewer for many
+                     conversations, to keep each batch's arrays near BATCH_CELLS entries)
+    Returns:
+        (n_boot x n_features) array of resampled means
+    """
+
+    obs = np.asarray(obs, dtype=float)
+    n = len(obs)
+    sizes = _batches(n_boot, batch_size, n)
+    seeds = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seeds = seeds.spawn(len(sizes))
+
+    def run(i):
+        rng = np.random.default_rng(seeds[i])
+        draws = rng.integers(0, n, size=(sizes[i], n))
+        draws += (np.arange(sizes[i]) * n)[:, None]
+        weights = np.bincount(draws.ravel(), minlength=sizes[i]*n).reshape(sizes[i], n)
+        return weights.astype(float) @ obs / n
+
+    return np.vstack(_map(run, range(len(sizes)), n_jobs))
+
+def codym_bootstrap(states_counts, trans_counts, states_counts_ref=None, trans_counts_ref=None,
+                    n_boot=10000, alpha=0.05, null=0, seed=None, n_jobs=None, batch_size=500):
+    """Bootstrap confidence intervals and significance for an average CODYM
+
+    Conversations are resampled with replacement, matching codym_avg (each
+    conversation weighted equally). If reference counts are given, the
+    CIs are for the difference CODYM (average - average of the reference
+    group), with each group resampled independently.
+
+    Inputs:
+        states_counts, trans_counts - per-conversation count matrices (from codym_counts)
+        states_counts_ref, trans_counts_ref - optional count matrices of a reference group
+        n_boot - the number of bootstrap resamples
+        alpha - significance level; CIs are the alpha/2 and 1-alpha/2 percentiles
+        null - value (or array) a state/transition is significant if its CI excludes
+        seed, n_jobs, batch_size - as for bootstrap_means
+    Returns:
+        dict with
+            'states_ci', 'trans_ci' - (2 x n) arrays of lower and upper CI bounds
+            'is_sig_state', 'is_sig_trans' - logical arrays, ready to pass to draw_codym
+    Example call:
+        boot = codym_bootstrap(*codym_counts(turn_lengths, offsets, 3), seed=0)
+        draw_codym(codym_norm, False, boot['is_sig_state'], boot['is_sig_trans'])
+    """
+
+    is_diff = states_counts_ref is not None
+    seeds = (seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)).spawn(4)
+
+    result = {}
+    for (name, sig_name, counts, counts_ref, seed_pair) in [
+            ('states_ci', 'is_sig_state', states_counts, states_counts_ref, seeds[:2]),
+            ('trans_ci', 'is_sig_trans', trans_counts, trans_counts_ref, seeds[2:])]:
+        means = bootstrap_means(codym_obs(counts), n_boot, seed_pair[0], n_jobs, batch_size)
+        if is_diff:
+            means -= bootstrap_means(codym_obs(counts_ref), n_boot, seed_pair[1], n_jobs, batch_size)
+        ci = np.quantile(means, [alpha/2, 1-alpha/2], axis=0)
+        result[name] = ci
+        result[sig_name] = (ci[0] > null) | (ci[1] < null)
+    return(result)
+
+def _resolved(n_exceed, n_perm, alpha, z):
+    """Whether each permutation p-value is confidently above or below alpha (Wilson interval)"""
+
+    p = (n_exceed + 1) / (n_perm + 1)
+    center = (p + z**2/(2*n_perm)) / (1 + z**2/n_perm)
+    half = z*np.sqrt(p*(1-p)/n_perm + z**2/(4*n_perm**2)) / (1 + z**2/n_perm)
+    return (center - half > alpha) | (center + half < alpha)
+
+def codym_permutation_test(states_counts, trans_counts, labels, n_perm=10000, alpha=0.05,
+                           seed=None, n_jobs=None, batch_size=500, batches_per_check=8, z=3):
+    """Permutation test of a difference CODYM between two groups of conversations
+
+    Group labels are shuffled across conversations, and the difference CODYM
+    (average of group 1 - average of group 0, as codym_avg) is recomputed for
+    a whole batch of permutations with one matrix product. Batches run in a
+    thread pool. After every batches_per_check batches, the run stops early
+    once every p-value is clearly above or below alpha (its Wilson interval at
+    z standard errors excludes alpha). Checks happen at fixed numbers of
+    batches, so results are reproducible for a seed regardless of n_jobs.
+
+    Inputs:
+        states_counts, trans_counts - per-conversation count matrices (from codym_counts)
+        labels - logical group of each conversation
+        n_perm - the maximum number of permutations
+        alpha - significance level of the two-sided test
+        seed - seed (or np.random.SeedSequence) for reproducible results
+        n_jobs - number of threads (default: all cores)
+        batch_size - the number of permutations computed at a time (fewer for many
+                     conversations, as for bootstrap_means)
+        batches_per_check - the number of batches between early-stopping checks
+        z - width of the early-stopping interval, in standard errors (None to disable)
+    Returns:
+        dict with
+            'states_diff', 'trans_diff' - the observed difference in frequencies
+            'states_p', 'trans_p' - permutation p-values
+            'is_sig_state', 'is_sig_trans' - p < alpha, ready to pass to draw_codym
+            'n_perm' - the number of permutations run
+    Example call:
+        perm = codym_permutation_test(states_counts, trans_counts, has_emotion, seed=0)
+        draw_codym(CODYM_emo, True, perm['is_sig_state'], perm['is_sig_trans'])
+    """
+
+    labels = np.asarray(labels, dtype=bool)
+    n_states = np.shape(states_counts)[1]
+    obs = np.hstack((codym_obs(states_counts), codym_obs(trans_counts)))
+    n_1 = labels.sum()
+    n_0 = len(labels) - n_1
+    if n_1 == 0 or n_0 == 0:
+        raise ValueError('Both groups must contain at least one conversation')
+
+    # Contrast weights giving mean(group 1) - mean(group 0) as a dot product
+    def diff(l):
+        return (l/n_1 - ~l/n_0) @ obs
+
+    observed = diff(labels)
+    threshold = np.abs(observed) - 1e-12 # Tolerate round-off in ties
+
+    sizes = _batches(n_perm, batch_size, len(labels))
+    seeds = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    seeds = seeds.spawn(len(sizes))
+
+    def run(i):
+        rng = np.random.default_rng(seeds[i])
+        perms = rng.permuted(np.tile(labels, (sizes[i], 1)), axis=1)
+        return (np.abs(diff(perms)) >= threshold).sum(axis=0)
+
+    n_exceed = np.zeros(obs.shape[1], dtype=np.int64)
+    n_done = 0
+    for first in range(0, len(sizes), batches_per_check):
+        batch_ids = range(first, min(first + batches_per_check, len(sizes)))
+        n_exceed += np.sum(_map(run, batch_ids, n_jobs), axis=0)
+        n_done += sum(sizes[i] for i in batch_ids)
+        if z is not None and np.all(_resolved(n_exceed, n_done, alpha, z)):
+            break
+
+    p = (n_exceed + 1) / (n_done + 1)
+    return({'states_diff': observed[:n_states], 'trans_diff': observed[n_states:],
+            'states_p': p[:n_states], 'trans_p': p[n_states:],
+            'is_sig_state': p[:n_states] < alpha, 'is_sig_trans': p[n_states:] < alpha,
+            'n_perm': n_done})
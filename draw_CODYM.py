@@ -12,10 +12,17 @@ from matplotlib import pyplot as plt
 from draw_order_2 import draw_order_2
 from draw_order_3 import draw_order_3
 
-def draw_codym(codym, is_diff = False):
+def draw_codym(codym, is_diff = False, is_sig_state = None, is_sig_trans = None):
     """Plot the state space diagram of 2nd- and 3rd-order codyms
+    
+    Non-significant states and transitions (e.g., as flagged by 
+    codym_bootstrap) are drawn in gray and with dashed edges. By default, all
+    are drawn as significant.
     """
     
+    if codym.n_levels != 2:
+        raise ValueError('Only CODYMs of binarized turn lengths can be drawn')
+    
     opts = {} # Plotting options
     
     states_obs = codym.states_obs
@@ -46,8 +53,13 @@ def draw_codym(codym, is_diff = False):
     opts['scale_edges'] = True
     opts['diag_edge_ang_dis'] = -23
 
-    opts['is_sig_state'] = [True]*len(codym.states_obs)
-    opts['is_sig_trans'] = [True]*len(codym.trans_obs)
+    if is_sig_state is None:
+        is_sig_state = [True]*len(codym.states_obs)
+    if is_sig_trans is None:
+        is_sig_trans = [True]*len(codym.trans_obs)
+    opts['is_sig_state'] = list(is_sig_state)
+    opts['is_sig_nodes'] = list(is_sig_state) # Name used by draw_order_2
+    opts['is_sig_trans'] = list(is_sig_trans)
     
     if codym.model_order == 2:
         fig, axes = plt.subplots(1,1,figsize=(8,4))
@@ -74,13 +74,17 @@ def draw_order_2(states_obs, states_order, trans_obs, trans_order, ax, opts):
     
     # Fill in any missing STATES w/ zeros and fix the ordering
     temp_states = []
+    temp_state_sig = []
     for state in states_all:
         i_state = np.where(np.all(states_order==state,axis=1))[0] # matching index from observed data
         if len(i_state):
             temp_states.append(states_obs[i_state[0]])
+            temp_state_sig.append(opts['is_sig_nodes'][i_state[0]] if 'is_sig_nodes' in opts else True)
         else:
             temp_states.append(0)
+            temp_state_sig.append(True)
     states_obs = temp_states
+    opts['is_sig_nodes'] = temp_state_sig
     
     # Fil in any missing TRANSITIONS w/ zeros and fix the ordering
     temp_trans = []
@@ -96,6 +100,7 @@ def draw_order_2(states_obs, states_order, trans_obs, trans_order, ax, opts):
         else:
             temp_trans.append(0)
             temp_is_sig.append(True)
+            temp_trans_lbls.append(0)
     trans_obs = temp_trans
     opts['is_sig'] = temp_is_sig
     opts['edge_labels'] = temp_trans_lbls
@@ -186,13 +191,10 @@ def draw_order_2(states_obs, states_order, trans_obs, trans_order, ax, opts):
         nodes = E_straight[i] # Get TO and FROM nodes for the straight edge
         
         color_i = (edge_weights[E_straight_i[i]]-w_range[0])/(w_range[1]-w_range[0])
-        if 'is_sig_trans' in opts:
-            if opts['is_sig_trans'][E_straight_i[i]]:
-                ls = sig_style
-            else:
-                ls = non_sig_style
-        else:
+        if opts['is_sig'][E_straight_i[i]]: # In transition_all order, as E_straight_i
             ls = sig_style
+        else:
+            ls = non_sig_style
         
         if opts['scale_edges']:
             ew = (np.abs(edge_weights[E_straight_i[i]])-0)/(w_range[1]-0)*(max_edge_width-min_edge_width)+min_edge_width
@@ -100,13 +100,17 @@ def draw_order_3(states_obs, states_order, trans_obs, trans_order, ax, opts):
     
     # Fill in any missing STATES w/ zeros and fix the ordering
     temp_states = []
+    temp_state_sig = []
     for state in states_all:
         i_state = np.where(np.all(states_order==state,axis=1))[0] # matching index from observed data
         if len(i_state):
             temp_states.append(states_obs[i_state[0]])
+            temp_state_sig.append(opts['is_sig_state'][i_state[0]] if 'is_sig_state' in opts else True)
         else:
             temp_states.append(0)
+            temp_state_sig.append(True)
     states_obs = temp_states
+    opts['is_sig_state'] = temp_state_sig
     
     # Fill in any missing TRANSITIONS w/ zeros and fix the ordering
     temp_trans = []
@@ -119,6 +123,7 @@ def draw_order_3(states_obs, states_order, trans_obs, trans_order, ax, opts):
             temp_trans_sig.append(opts['is_sig_trans'][i_trans[0]])
         else:
             temp_trans.append(0)
+            temp_trans_sig.append(True)
     trans_obs = temp_trans
     opts['is_sig_trans'] = temp_trans_sig    
     